@@ -0,0 +1,234 @@
+import math
+import os
+import threading
+import time
+from functools import wraps
+from flask import abort, current_app
+
+from batch import is_subrequest
+
+'''
+Admission control for the route handlers
+
+Every request that reaches a handler needs a database connection. When
+more requests arrive than the connection pool can serve they used to
+pile up inside the pool until gunicorn killed the worker. The
+AdmissionController below keeps a count of the requests currently
+running, lets a bounded number of requests wait (with a deadline) for a
+free slot and sheds everything else with a fast 503 + Retry-After.
+
+Under a thread per request server the limit is also at most half of the
+worker's threads (limit_to_threads, called by gunicorn.conf.py): a
+request can only wait in the queue while it holds a thread, so the
+other half of the threads hold the waiting requests. Without them
+every request above the limit would wait unseen in the listen backlog
+of the socket, never shed.
+
+Routes are given a priority. High priority requests (cheap reads) may
+use every slot, lower priorities are only admitted while some of the
+pool is still free so that expensive bulk work is shed first.
+'''
+
+# Request priorities. Lower number means more important.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# Tunables, read from environment variables like the Auth0 settings
+# ADMISSION_MAX_CONCURRENCY = 0 means "use the size of the db pool"
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true') == 'true'
+ADMISSION_MAX_CONCURRENCY = int(
+    os.environ.get('ADMISSION_MAX_CONCURRENCY', '0'))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '64'))
+ADMISSION_QUEUE_TIMEOUT = float(
+    os.environ.get('ADMISSION_QUEUE_TIMEOUT', '2.0'))
+ADMISSION_RESERVE = int(os.environ.get('ADMISSION_RESERVE', '2'))
+
+
+def pool_capacity(pool):
+    """Returns the number of connections the pool can hand out, or None
+    when the pool is unbounded (NullPool, StaticPool...)
+    """
+    if not hasattr(pool, 'size') or not hasattr(pool, '_max_overflow'):
+        return None
+    overflow = pool._max_overflow
+    if overflow < 0:
+        # negative max_overflow means unlimited overflow
+        return None
+    return pool.size() + overflow
+
+
+class AdmissionController:
+    def __init__(self, pool_getter=None, max_concurrency=0, max_queue=64,
+                 queue_timeout=2.0, reserve=2):
+        # pool_getter is a callable returning the SQLAlchemy pool. It is
+        # called lazily because the engine only exists inside an app
+        # context
+        self.pool_getter = pool_getter
+        self.max_concurrency = max_concurrency
+        self.reserve = reserve
+        # lower priorities get a shorter queue and a shorter deadline
+        self.max_queue = {
+            PRIORITY_HIGH: max_queue,
+            PRIORITY_NORMAL: max_queue,
+            PRIORITY_LOW: max(max_queue // 4, 1)
+        }
+        self.queue_timeout = {
+            PRIORITY_HIGH: queue_timeout,
+            PRIORITY_NORMAL: queue_timeout,
+            PRIORITY_LOW: queue_timeout / 4
+        }
+        # threads of the worker, None when unknown
+        self.threads = None
+        self.active = 0
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.shed = {priority: 0 for priority in PRIORITIES}
+        self.condition = threading.Condition()
+
+    def _pool(self):
+        if self.pool_getter is None:
+            return None
+        try:
+            return self.pool_getter()
+        except Exception:
+            return None
+
+    def limit(self):
+        """Number of requests allowed to run at the same time"""
+        limit = self.max_concurrency
+        pool = self._pool()
+        capacity = pool_capacity(pool) if pool is not None else None
+        if capacity is not None:
+            limit = min(limit, capacity) if limit > 0 else capacity
+        if self.threads is not None:
+            # the other threads hold the waiting requests
+            running = max(self.threads // 2, 1)
+            limit = min(limit, running) if limit > 0 else running
+        if limit <= 0:
+            # no pool information and no configured limit
+            limit = 1 << 30
+        return limit
+
+    def limit_to_threads(self, threads):
+        self.threads = threads
+
+    def in_use(self):
+        """Slots in use: running requests or checked out connections
+        (connections may also be held outside of a request, e.g. by
+        background threads), whichever is larger
+        """
+        pool = self._pool()
+        checked_out = 0
+        if pool is not None and hasattr(pool, 'checkedout'):
+            checked_out = pool.checkedout()
+        return max(self.active, checked_out)
+
+    def slots(self, priority):
+        """Number of slots a request of the given priority may fill"""
+        limit = self.limit()
+        return max(limit - self.reserve * priority, 1)
+
+    def _can_run(self, priority):
+        # a request only goes ahead of more important waiters if there
+        # are none of them
+        for higher in PRIORITIES[:priority]:
+            if self.waiting[higher]:
+                return False
+        return self.in_use() < self.slots(priority)
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """Blocks until the request may run. Returns False when the
+        request has to be shed
+        """
+        with self.condition:
+            if self._can_run(priority):
+                self.active += 1
+                return True
+
+            if self.waiting[priority] >= self.max_queue[priority]:
+                self.shed[priority] += 1
+                return False
+
+            deadline = time.monotonic() + self.queue_timeout[priority]
+            self.waiting[priority] += 1
+            try:
+                while not self._can_run(priority):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed[priority] += 1
+                        return False
+                    # pool connections can also be returned by code we
+                    # don't track, so wake up periodically to re-check
+                    self.condition.wait(min(remaining, 0.05))
+                self.active += 1
+                return True
+            finally:
+                self.waiting[priority] -= 1
+                # a waiter leaving may unblock lower priorities
+                self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def retry_after(self, priority=PRIORITY_NORMAL):
+        """Seconds a shed client should wait before retrying"""
+        return max(int(math.ceil(self.queue_timeout[priority])), 1)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'active': self.active,
+                'limit': self.limit(),
+                'waiting': dict(self.waiting),
+                'shed': dict(self.shed)
+            }
+
+
+def init_admission(app, db):
+    """Creates the AdmissionController for the app from the ADMISSION_*
+    environment variables
+    """
+    controller = AdmissionController(
+        pool_getter=lambda: db.get_engine(app).pool,
+        max_concurrency=ADMISSION_MAX_CONCURRENCY,
+        max_queue=ADMISSION_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        reserve=ADMISSION_RESERVE)
+    app.extensions['admission'] = controller
+    return controller
+
+
+'''
+@admission_control(priority) decorator
+
+Place it directly below @app.route (and @deadline) so that shed
+requests don't pay for the token verification. Responds with abort(503) when the request can't
+be admitted; the 503 error handler adds the Retry-After header.
+'''
+
+
+def admission_control(priority=PRIORITY_NORMAL):
+    def admission_control_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            controller = current_app.extensions.get('admission')
+            # a /batch takes one slot for all of its sub-requests
+            if controller is None or not ADMISSION_ENABLED or \
+                    is_subrequest():
+                return f(*args, **kwargs)
+
+            if not controller.acquire(priority):
+                abort(503, {
+                    'message': 'Server is busy, please retry later',
+                    'retry_after': controller.retry_after(priority)})
+            try:
+                return f(*args, **kwargs)
+            finally:
+                controller.release()
+
+        return wrapper
+    return admission_control_decorator
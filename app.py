@@ -1,12 +1,32 @@
 import os
 import sys
-from flask import Flask, request, abort, jsonify
+from datetime import date
+from flask import Flask, request, abort, jsonify, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 # import setup_db function from models to initialize Postgres database
-from models import setup_db, Actors, Movies, db
+from models import setup_db, Actors, Movies, CatalogStats, db
+import stats
+from changes import change_feed, parse_token, DEFAULT_LIMIT, MAX_LIMIT
+import events
+from queries import (get_by_id, list_by_id, list_by_ids,
+                     list_movies_released, LOOKUP_MAX_IDS)
 
 from auth import AuthError, requires_auth
+from admission import (init_admission, admission_control, PRIORITY_HIGH,
+                       PRIORITY_NORMAL, PRIORITY_LOW)
+from replicas import use_replica
+from idempotency import init_idempotency, idempotent
+from compression import init_compression
+from singleflight import init_single_flight, single_flight
+from readmodel import init_read_model, read_model
+from batch import run_batch
+from versions import with_etag, check_if_match, stale_write
+from deadlines import init_deadlines, deadline, DeadlineExceeded
+from warmup import init_warm_up
+from sqlalchemy.orm.exc import StaleDataError
+# checks that keep database connections from crossing a fork
+import prefork  # noqa: F401
 
 
 def create_app(test_config=None):
@@ -15,12 +35,68 @@ def create_app(test_config=None):
     # call the setup_db() function from model.py to setup the POSTgres database
     setup_db(app)
     CORS(app)
+    # limit concurrent requests to what the db connection pool can serve
+    init_admission(app, db)
+    # stored responses for requests with an Idempotency-Key header
+    init_idempotency(app, db)
+    # gzip/br/zstd responses, with a cache of compressed bodies
+    init_compression(app)
+    # identical concurrent list requests share one query and response
+    init_single_flight(app)
+    # in-memory snapshot of actors and movies, if READ_MODEL_ENABLED
+    init_read_model(app)
+    # time limits of the routes, also for their queries
+    init_deadlines(app)
+    # state of the warm-up, see /readyz
+    init_warm_up(app)
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        # liveness only: no database, no token
+        return jsonify({
+            'success': True,
+            'status': 'alive'
+        })
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        # only reports the state of the warm-up. It is started here if
+        # the server didn't (e.g. python app.py) and runs in its own
+        # thread
+        warm_up = app.extensions['warm_up']
+        warm_up.start(app)
+        if not warm_up.ready:
+            abort(503, {
+                'message': 'Worker is warming up, please retry later',
+                'retry_after': 1})
+
+        return jsonify({
+            'success': True,
+            'status': 'ready',
+            'warm_up_seconds': warm_up.seconds
+        })
 
     @app.route('/actors', methods=['GET'])
+    @deadline('DEADLINE_READ')
+    @admission_control(PRIORITY_HIGH)
     @requires_auth('get:actors')
+    @use_replica
+    @single_flight
     def get_actors(payload):
+        ids = ids_argument()
+        if ids is not None:
+            actors, missing = lookup(Actors, ids)
+            return jsonify({
+                'success': True,
+                'actors': [actor.format() for actor in actors],
+                'missing': missing
+            })
 
-        actors = Actors.query.order_by(Actors.id).all()
+        snapshot = read_model()
+        if snapshot is not None:
+            actors = snapshot.all('actors')
+        else:
+            actors = list_by_id(Actors)
 
         # print(actors)
 
@@ -34,10 +110,37 @@ def create_app(test_config=None):
         })
 
     @app.route('/movies', methods=['GET'])
+    @deadline('DEADLINE_READ')
+    @admission_control(PRIORITY_HIGH)
     @requires_auth('get:movies')
+    @use_replica
+    @single_flight
     def get_movies(payload):
+        ids = ids_argument()
+        start = date_argument('release_date_from')
+        end = date_argument('release_date_to')
+
+        if ids is not None:
+            if start is not None or end is not None:
+                abort(422, {
+                    'message': 'ids can not be combined with a release date'})
+            movies, missing = lookup(Movies, ids)
+            return jsonify({
+                'success': True,
+                'movies': [movie.format() for movie in movies],
+                'missing': missing
+            })
 
-        movies = Movies.query.order_by(Movies.id).all()
+        snapshot = read_model()
+        if snapshot is not None:
+            if start is None and end is None:
+                movies = snapshot.all('movies')
+            else:
+                movies = snapshot.range('movies', 'release_date', start, end)
+        elif start is None and end is None:
+            movies = list_by_id(Movies)
+        else:
+            movies = list_movies_released(start, end)
 
         # print(movies)
 
@@ -50,8 +153,145 @@ def create_app(test_config=None):
             'movies': movies_formatted
         })
 
+    def ids_argument():
+        # ?ids=3,1,2, each id once in the order given
+        value = request.args.get('ids')
+        if value is None:
+            return None
+        try:
+            ids = list(dict.fromkeys(int(id) for id in value.split(',')))
+        except ValueError:
+            abort(422, {'message': 'Invalid ids, use e.g. ids=1,2,3'})
+        if len(ids) > LOOKUP_MAX_IDS:
+            abort(422, {
+                'message': 'At most %d ids per request' % LOOKUP_MAX_IDS})
+        return ids
+
+    def lookup(model, ids):
+        # records in the order of ids (one query), and the ids not found
+        snapshot = read_model()
+        if snapshot is not None:
+            records = [snapshot.get(model.__tablename__, id) for id in ids]
+        else:
+            records = list_by_ids(model, ids)
+        found = {record.id: record for record in records
+                 if record is not None}
+        return ([found[id] for id in ids if id in found],
+                [id for id in ids if id not in found])
+
+    def date_argument(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            abort(422, {'message': 'Invalid date for %s, use YYYY-MM-DD' % name})
+
+    @app.route('/actors/changes', methods=['GET'])
+    @deadline('DEADLINE_READ')
+    @admission_control(PRIORITY_HIGH)
+    @requires_auth('get:actors')
+    @use_replica
+    def get_actor_changes(payload):
+        since, limit = changes_arguments()
+
+        changes, next_token, has_more = change_feed(
+            Actors, 'actor', since, limit)
+
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'next_token': next_token,
+            'has_more': has_more
+        })
+
+    @app.route('/movies/changes', methods=['GET'])
+    @deadline('DEADLINE_READ')
+    @admission_control(PRIORITY_HIGH)
+    @requires_auth('get:movies')
+    @use_replica
+    def get_movie_changes(payload):
+        since, limit = changes_arguments()
+
+        changes, next_token, has_more = change_feed(
+            Movies, 'movie', since, limit)
+
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'next_token': next_token,
+            'has_more': has_more
+        })
+
+    def changes_arguments():
+        since = parse_token(request.args.get('since'))
+        if since is None:
+            abort(422, {'message': 'Invalid change token'})
+
+        limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+        if limit < 1:
+            abort(422, {'message': 'Invalid limit'})
+
+        return since, min(limit, MAX_LIMIT)
+
+    @app.route('/events', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_events(payload):
+        # no admission control, the stream holds no database connection
+        if not events.streams_supported(request.environ):
+            abort(503, {
+                'message': 'Event streams need a threaded or async server'})
+        events.broker.ensure_listener(db.engine)
+        # the subscriber is counted by the stream itself
+        if events.broker.full():
+            abort(503, {
+                'message': 'Too many event streams, please retry later',
+                'retry_after': 30})
+
+        return Response(
+            events.stream(events.broker, set(payload.get('permissions', []))),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+
+    @app.route('/stats', methods=['GET'])
+    @deadline('DEADLINE_READ')
+    @admission_control(PRIORITY_HIGH)
+    @requires_auth('get:actors')
+    @use_replica
+    def get_stats(payload):
+        # counters are kept up to date by the write handlers, so this
+        # reads a handful of rows instead of scanning actors and movies
+        catalog_stats = stats.read(db.session, CatalogStats.__table__)
+
+        result = {
+            'success': True,
+            'actors': catalog_stats['actors']
+        }
+        if 'get:movies' in payload.get('permissions', []):
+            result['movies'] = catalog_stats['movies']
+
+        return jsonify(result)
+
+    @app.route('/batch', methods=['POST'])
+    @deadline('DEADLINE_BATCH')
+    # bulk work, shed before single reads and writes
+    @admission_control(PRIORITY_LOW)
+    @requires_auth(None)
+    @idempotent
+    def batch(payload):
+        # the token is verified here once, every sub-request still
+        # checks its own permission
+        return run_batch(app, db, payload, request.get_json())
+
     @app.route('/actors', methods=['POST'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('post:actors')
+    @idempotent
     def add_actor(payload):
         body = request.get_json()
 
@@ -73,16 +313,16 @@ def create_app(test_config=None):
 
             actor.insert()
 
-            actors = Actors.query.order_by(Actors.id).all()
-            total_actors = len(actors)
-            last_actor = actors[total_actors - 1].format()
-            # actors_formatted = [actor.format() for actor in actors]
-
-            return jsonify({
+            # insert() sets the id of the new actor, no need to query
+            # the whole table for the last one
+            return with_etag(jsonify({
                 'success': True,
-                'actor_added': last_actor
-            })
+                'actor_added': actor.format()
+            }), actor)
 
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -92,7 +332,10 @@ def create_app(test_config=None):
             db.session.close()
 
     @app.route('/movies', methods=['POST'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('post:movies')
+    @idempotent
     def add_movie(payload):
         body = request.get_json()
 
@@ -110,16 +353,16 @@ def create_app(test_config=None):
 
             movie.insert()
 
-            movies = Movies.query.order_by(Movies.id).all()
-            total_movies = len(movies)
-            last_movie = movies[total_movies - 1].format()
-            # movies_formatted = [movie.format() for movie in movies]
-
-            return jsonify({
+            # insert() sets the id of the new movie, no need to query
+            # the whole table for the last one
+            return with_etag(jsonify({
                 'success': True,
-                'movie_added': last_movie
-            })
+                'movie_added': movie.format()
+            }), movie)
 
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -128,16 +371,23 @@ def create_app(test_config=None):
             db.session.close()
 
     @app.route('/actors/<int:id>', methods=['PATCH'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('update:actors')
+    @idempotent
     def update_actors(payload, id):
 
-        actor = Actors.query.get(id)
+        actor = get_by_id(Actors, id)
 
         if actor is None:
             abort(
                 404, {
                     'message': 'Actor ID requested not found in the database'})
 
+        # 412 right away for a stale If-Match, the UPDATE checks the
+        # version again in case the row changes in the meantime
+        check_if_match(actor)
+
         data = request.get_json()
 
         try:
@@ -152,10 +402,16 @@ def create_app(test_config=None):
 
             actor.update()
 
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
                 'actor': actor.format()
-            })
+            }), actor)
+        except StaleDataError:
+            db.session.rollback()
+            stale_write()
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -166,16 +422,23 @@ def create_app(test_config=None):
             db.session.close()
 
     @app.route('/movies/<int:id>', methods=['PATCH'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('update:movies')
+    @idempotent
     def update_movies(payload, id):
 
-        movie = Movies.query.get(id)
+        movie = get_by_id(Movies, id)
 
         if movie is None:
             abort(
                 404, {
                     'message': 'Movie ID requested not found in the database'})
 
+        # 412 right away for a stale If-Match, the UPDATE checks the
+        # version again in case the row changes in the meantime
+        check_if_match(movie)
+
         data = request.get_json()
 
         try:
@@ -187,10 +450,16 @@ def create_app(test_config=None):
 
             movie.update()
 
-            return jsonify({
+            return with_etag(jsonify({
                 'success': True,
                 'movie': movie.format()
-            })
+            }), movie)
+        except StaleDataError:
+            db.session.rollback()
+            stale_write()
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -201,15 +470,19 @@ def create_app(test_config=None):
             db.session.close()
 
     @app.route('/actors/<int:id>', methods=['DELETE'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('delete:actors')
     def delete_actor(payload, id):
-        actor = Actors.query.get(id)
+        actor = get_by_id(Actors, id)
 
         if actor is None:
             abort(
                 404, {
                     'message': 'Actor ID requested not found in the database'})
 
+        check_if_match(actor)
+
         try:
 
             actor.delete()
@@ -219,6 +492,12 @@ def create_app(test_config=None):
                 'deleted_actor': actor.format()
             })
 
+        except StaleDataError:
+            db.session.rollback()
+            stale_write()
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -227,15 +506,19 @@ def create_app(test_config=None):
             db.session.close()
 
     @app.route('/movies/<int:id>', methods=['DELETE'])
+    @deadline('DEADLINE_WRITE')
+    @admission_control(PRIORITY_NORMAL)
     @requires_auth('delete:movies')
     def delete_movie(payload, id):
-        movie = Movies.query.get(id)
+        movie = get_by_id(Movies, id)
 
         if movie is None:
             abort(
                 404, {
                     'message': 'Movie ID requested not found in the database'})
 
+        check_if_match(movie)
+
         try:
 
             movie.delete()
@@ -245,6 +528,12 @@ def create_app(test_config=None):
                 'deleted_movie': movie.format()
             })
 
+        except StaleDataError:
+            db.session.rollback()
+            stale_write()
+        except DeadlineExceeded:
+            db.session.rollback()
+            raise
         except BaseException:
             db.session.rollback()
             print(sys.exc_info())
@@ -279,6 +568,44 @@ def create_app(test_config=None):
             "message": error_message(error, "resource not found")
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": error_message(error, "Conflict")
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": error_message(error, "Precondition failed")
+        }), 412
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": error_message(error, "Service unavailable")
+        })
+        try:
+            response.headers['Retry-After'] = str(
+                error.description['retry_after'])
+        except BaseException:
+            pass
+        return response, 503
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(error):
+        return jsonify({
+            "success": False,
+            "error": 504,
+            "message": error.message
+        }), 504
+
     @app.errorhandler(AuthError)
     def process_AuthError(AuthError):
         return jsonify({
@@ -1,4 +1,7 @@
 import json
+import sys
+import threading
+import time
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
@@ -6,6 +9,8 @@ from urllib.request import urlopen
 # import os for accessing environment variables using os.environ command
 import os
 
+import deadlines
+
 # Auth0 variables below will be read from environment variables
 # These variables are save in setup.sh file for this project. On Heroku
 # they will be setup as config variables
@@ -13,6 +18,19 @@ AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = [os.environ['ALGORITHMS']]
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# WSGI environ key of a payload that was already verified. /batch sets
+# it for its sub-requests, so the token is verified once per batch
+VERIFIED_PAYLOAD = 'casting_agency.jwt_payload'
+
+# The signing keys of the Auth0 domain are fetched once and kept for
+# JWKS_CACHE_SECONDS. A token signed with an unknown key (key rotation)
+# refetches them, at most every JWKS_MIN_REFRESH_SECONDS
+JWKS_CACHE_SECONDS = float(os.environ.get('JWKS_CACHE_SECONDS', '3600'))
+JWKS_MIN_REFRESH_SECONDS = float(
+    os.environ.get('JWKS_MIN_REFRESH_SECONDS', '60'))
+# socket timeout of the key download, shortened to the request deadline
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', '5'))
+
 # print out the variables to test they are getting loaded properly
 # print(AUTH0_DOMAIN)
 # print(ALGORITHMS)
@@ -122,16 +140,53 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    # print('Inside the verify_decode_jwt() function\n')
-
-    # Obtain the public key information for the domain defined
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+class JWKSCache:
+    def __init__(self):
+        self.keys = None
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        # Obtain the public key information for the domain defined
+        jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                          timeout=deadlines.timeout(JWKS_FETCH_TIMEOUT))
+        jwks = json.loads(jsonurl.read())
+        # keys by kid, in the form jwt.decode() takes them
+        self.keys = {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys']}
+        self.fetched = time.monotonic()
+
+    def get(self, kid):
+        """Returns the key with id kid, None if the domain has none"""
+        with self.lock:
+            age = time.monotonic() - self.fetched
+            if self.keys is None or age > JWKS_CACHE_SECONDS or \
+                    (kid not in self.keys and
+                     age > JWKS_MIN_REFRESH_SECONDS):
+                try:
+                    self.fetch()
+                except Exception:
+                    # keep using the keys we have while Auth0 is away
+                    if self.keys is None:
+                        # 504 when the request ran out of time
+                        deadlines.check()
+                        raise
+                    print(sys.exc_info())
+            return self.keys.get(kid)
+
+
+jwks_cache = JWKSCache()
 
-    jwks = json.loads(jsonurl.read())
 
-    # print('Public Key Information for the Auth0 domain \n')
-    # print(jwks)
+def verify_decode_jwt(token):
+    # print('Inside the verify_decode_jwt() function\n')
 
     # Obtain the header information from the token submitted which was
     # generated by a user logging into Autho
@@ -139,22 +194,13 @@ def verify_decode_jwt(token):
     # print('Header Obtained by decoding the token using the jwt module \n')
     # print(unverified_header)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -200,6 +246,8 @@ def verify_decode_jwt(token):
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
+
+    permission=None only requires a valid token
 '''
 
 
@@ -207,9 +255,15 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload = request.environ.get(VERIFIED_PAYLOAD)
+            if payload is None:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+            if permission is not None:
+                check_permissions(permission, payload)
+            # keep the payload around for code that doesn't get it passed
+            # in, e.g. read replica routing
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,167 @@
+import os
+import sys
+from flask import g, request, abort, jsonify, has_request_context
+from werkzeug.test import EnvironBuilder
+
+import events
+from auth import VERIFIED_PAYLOAD
+
+'''
+/batch endpoint
+
+A batch is an ordered list of sub-requests against the other routes:
+
+    {
+        "transactional": false,
+        "requests": [
+            {"method": "GET", "path": "/actors"},
+            {"method": "PATCH", "path": "/movies/2", "body": {"title": "X"}}
+        ]
+    }
+
+The token is verified once for the whole batch. Every sub-request runs
+through the normal route (permission checks, validation, error
+handlers) with the verified payload in its WSGI environ, in the same
+app context and therefore the same database session. Admission control
+counts the batch once.
+
+With "transactional": true all sub-requests share one database
+transaction: the session is pinned to one connection (g.db_connection,
+see RoutingSession.get_bind) and the write coalescer is bypassed. The
+batch stops at the first sub-request that fails and nothing is
+committed.
+'''
+
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '20'))
+
+# WSGI environ key marking a sub-request of a batch
+SUBREQUEST = 'casting_agency.subrequest'
+
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+# routes that can't run inside a batch
+EXCLUDED_PATHS = ('/batch', '/events')
+
+
+def is_subrequest():
+    return has_request_context() and bool(request.environ.get(SUBREQUEST))
+
+
+def parse_batch(body):
+    """Returns the sub-requests as (method, path, body) tuples, aborts
+    with 422 for invalid batches
+    """
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('requests'), list) or \
+            not body['requests']:
+        abort(422, {'message': 'List of requests not provided'})
+
+    if len(body['requests']) > BATCH_MAX_REQUESTS:
+        abort(422, {'message': 'A batch can have at most %d requests' %
+                    BATCH_MAX_REQUESTS})
+
+    subrequests = []
+    for index, subrequest in enumerate(body['requests']):
+        if not isinstance(subrequest, dict):
+            abort(422, {'message': 'Request %d is not an object' % index})
+
+        method = str(subrequest.get('method', 'GET')).upper()
+        path = subrequest.get('path')
+        if method not in METHODS:
+            abort(422, {'message': 'Method of request %d not supported' %
+                        index})
+        if not isinstance(path, str) or not path.startswith('/') or \
+                path.split('?')[0].rstrip('/') in EXCLUDED_PATHS:
+            abort(422, {'message': 'Invalid path for request %d' % index})
+
+        subrequests.append((method, path, subrequest.get('body')))
+    return subrequests
+
+
+def subrequest_environ(method, path, body, payload):
+    builder = EnvironBuilder(
+        path=path, method=method, json=body, base_url=request.host_url)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    environ[VERIFIED_PAYLOAD] = payload
+    environ[SUBREQUEST] = True
+    return environ
+
+
+def run_subrequest(app, environ):
+    """Dispatches one sub-request, returns (status, body)"""
+    # only the handler that sets it reads from a replica
+    g.pop('use_replica', None)
+    with app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception:
+            print(sys.exc_info())
+            return 500, {
+                'success': False,
+                'error': 500,
+                'message': 'Internal server error'
+            }
+    return response.status_code, response.get_json(silent=True)
+
+
+def run_batch(app, db, payload, body):
+    subrequests = parse_batch(body)
+    if body.get('transactional', False):
+        return run_transactional(app, db, payload, subrequests)
+
+    responses = []
+    for method, path, subrequest_body in subrequests:
+        status, data = run_subrequest(
+            app, subrequest_environ(method, path, subrequest_body, payload))
+        responses.append({'status': status, 'body': data})
+
+    return jsonify({
+        'success': True,
+        'responses': responses
+    })
+
+
+def run_transactional(app, db, payload, subrequests):
+    db.session.close()
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    # the session joins this transaction, commits of the handlers
+    # don't end it
+    g.db_connection = connection
+    responses = []
+    try:
+        for index, (method, path, subrequest_body) in enumerate(subrequests):
+            status, data = run_subrequest(
+                app,
+                subrequest_environ(method, path, subrequest_body, payload))
+            responses.append({'status': status, 'body': data})
+            if status >= 400:
+                transaction.rollback()
+                return jsonify({
+                    'success': False,
+                    'error': 422,
+                    'message': 'Request %d failed, no changes were made' %
+                               index,
+                    'failed': index,
+                    'responses': responses
+                }), 422
+
+        try:
+            transaction.commit()
+        except Exception:
+            print(sys.exc_info())
+            abort(422, {'message': 'Failed to commit the batch'})
+        events.publish_committed(connection)
+
+        return jsonify({
+            'success': True,
+            'responses': responses
+        })
+    finally:
+        g.pop('db_connection', None)
+        db.session.close()
+        if transaction.is_active:
+            transaction.rollback()
+        connection.close()
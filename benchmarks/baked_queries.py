@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+# run from the project directory: python benchmarks/baked_queries.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from models import setup_db, db, Actors  # noqa: E402
+from queries import get_by_id, list_by_id  # noqa: E402
+
+'''
+CPU time of the hot queries with and without baking (see queries.py)
+
+Runs the lookup of one actor by id and the ordered list of all actors
+ITERATIONS times each way and prints the CPU time (process time, so
+waiting for the database doesn't count) per call. The session is
+emptied after every call, like it is after every request, so get()
+can't answer from the identity map.
+
+    $ source setup.sh
+    $ python benchmarks/baked_queries.py [iterations]
+'''
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+
+def cpu_per_call(fn):
+    # warm up, the first baked call builds and compiles the query
+    fn()
+    db.session.remove()
+    start = time.process_time()
+    for iteration in range(ITERATIONS):
+        fn()
+        db.session.remove()
+    return (time.process_time() - start) / ITERATIONS * 1e6
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    setup_db(app)
+
+    with app.app_context():
+        actor = Actors.query.first()
+        if actor is None:
+            sys.exit('add an actor first')
+        actor_id = actor.id
+        db.session.remove()
+
+        rows = [
+            ('get by id', lambda: Actors.query.get(actor_id),
+             lambda: get_by_id(Actors, actor_id)),
+            ('list by id', lambda: Actors.query.order_by(Actors.id).all(),
+             lambda: list_by_id(Actors))
+        ]
+        print('iterations: %d, actors: %d' % (
+            ITERATIONS, Actors.query.count()))
+        print('%-12s %10s %10s %8s' % ('query', 'plain us', 'baked us',
+                                       'saved'))
+        for name, plain_fn, baked_fn in rows:
+            plain = cpu_per_call(plain_fn)
+            baked_time = cpu_per_call(baked_fn)
+            print('%-12s %10.1f %10.1f %7.0f%%' % (
+                name, plain, baked_time, (1 - baked_time / plain) * 100))
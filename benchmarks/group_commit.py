@@ -0,0 +1,73 @@
+import os
+import sys
+import threading
+import time
+
+# run from the project directory: python benchmarks/group_commit.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from models import setup_db, db, Actors  # noqa: E402
+from coalescer import WriteCoalescer  # noqa: E402
+
+'''
+Concurrent insert benchmark for the group commit (see coalescer.py)
+
+Starts THREADS threads which each insert WRITES actors through
+Actors.insert(), once committing every write on its own and once with
+the WriteCoalescer, and prints the writes per second of both runs.
+The actors are deleted again afterwards.
+
+    $ source setup.sh
+    $ python benchmarks/group_commit.py [threads] [writes per thread]
+'''
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+WRITES = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+
+def run(app):
+    def worker(number):
+        with app.app_context():
+            for write in range(WRITES):
+                Actors(name='bench-%d-%d' % (number, write), age=30,
+                       gender='female').insert()
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(number,))
+               for number in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return THREADS * WRITES / (time.perf_counter() - start)
+
+
+def cleanup(app):
+    with app.app_context():
+        Actors.query.filter(Actors.name.like('bench-%')).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    # one pool connection per thread, so the plain run isn't pool bound
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': THREADS, 'max_overflow': 0}
+    setup_db(app)
+    app.extensions.pop('coalescer', None)
+
+    plain = run(app)
+    cleanup(app)
+
+    coalescer = WriteCoalescer(lambda: db.get_engine(app))
+    app.extensions['coalescer'] = coalescer
+    grouped = run(app)
+    cleanup(app)
+
+    print('threads: %d, writes per thread: %d' % (THREADS, WRITES))
+    print('commit per write: %8.0f writes/s' % plain)
+    print('group commit:     %8.0f writes/s (%.1f writes per commit)' % (
+        grouped, coalescer.writes / max(coalescer.batches, 1)))
@@ -0,0 +1,127 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+# run from the project directory: python benchmarks/preload.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+'''
+Worker memory and boot cost of gunicorn with and without preload_app
+(see gunicorn.conf.py and prefork.py). Linux only, it reads /proc.
+
+Starts gunicorn with WORKERS workers, once with GUNICORN_PRELOAD=true
+and once with false, sends a few requests and prints per worker:
+    rss   resident memory, shared pages included
+    pss   resident memory with shared pages divided between the
+          processes sharing them
+    uss   memory only this worker uses
+plus the time until the first response and the CPU time all processes
+spent until then.
+
+    $ source setup.sh
+    $ python benchmarks/preload.py [workers]
+'''
+
+WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+REQUESTS = 200
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def children(pid):
+    result = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            result.append(int(entry))
+    return result
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def memory_kb(pid):
+    values = {}
+    with open('/proc/%d/smaps_rollup' % pid) as smaps:
+        for line in smaps:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:',
+                            'Private_Dirty:'):
+                values[parts[0]] = int(parts[1])
+    return (values['Rss:'], values['Pss:'],
+            values['Private_Clean:'] + values['Private_Dirty:'])
+
+
+def request(port):
+    try:
+        urlopen('http://127.0.0.1:%d/actors' % port, timeout=5).read()
+    except HTTPError:
+        # 401 without a token, the worker answered
+        return True
+    except URLError:
+        return False
+    return True
+
+
+def run(preload):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(WORKERS),
+               GUNICORN_PRELOAD='true' if preload else 'false')
+    start = time.perf_counter()
+    master = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while not request(port):
+            if master.poll() is not None:
+                sys.exit('gunicorn exited, check the environment')
+            time.sleep(0.01)
+        first_response = time.perf_counter() - start
+        # wait for all workers, then let each of them serve requests
+        while len(children(master.pid)) < WORKERS:
+            time.sleep(0.05)
+        time.sleep(1)
+        workers = children(master.pid)
+        boot_cpu = sum(cpu_seconds(pid) for pid in workers + [master.pid])
+        for number in range(REQUESTS):
+            request(port)
+        memory = [memory_kb(pid) for pid in workers]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+    count = len(memory)
+    return (first_response, boot_cpu,
+            sum(m[0] for m in memory) / count / 1024,
+            sum(m[1] for m in memory) / count / 1024,
+            sum(m[2] for m in memory) / count / 1024)
+
+
+if __name__ == '__main__':
+    print('workers: %d' % WORKERS)
+    print('%-10s %10s %10s %9s %9s %9s' % (
+        'preload', 'first req', 'boot cpu', 'rss MB', 'pss MB', 'uss MB'))
+    for preload in (False, True):
+        print('%-10s %9.2fs %9.2fs %9.1f %9.1f %9.1f' % (
+            (preload,) + run(preload)))
@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import tracemalloc
+
+# run from the project directory: python benchmarks/read_model.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from models import setup_db, db, Actors, Movies  # noqa: E402
+from queries import get_by_id, list_by_id, list_movies_released  # noqa: E402
+from readmodel import ReadModel  # noqa: E402
+
+'''
+Read model (see readmodel.py) against the SQL path of the handlers
+
+Loads the snapshot once and prints its memory per row (tracemalloc,
+records, strings, dates and indexes included), then the wall time per
+call of the lookups of GET /actors and GET /movies both ways. The
+session is emptied after every SQL call, like it is after every
+request. Fill the database first, e.g. with python manage.py import.
+
+    $ source setup.sh
+    $ python benchmarks/read_model.py [iterations]
+'''
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+
+def wall_per_call(fn):
+    fn()
+    db.session.remove()
+    start = time.perf_counter()
+    for iteration in range(ITERATIONS):
+        fn()
+        db.session.remove()
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    setup_db(app)
+
+    with app.app_context():
+        actor = Actors.query.order_by(Actors.id.desc()).first()
+        movie = Movies.query.order_by(Movies.release_date).first()
+        if actor is None or movie is None:
+            sys.exit('add actors and movies first')
+        actor_id = actor.id
+        start = movie.release_date
+        end = start.replace(year=start.year + 1)
+        db.session.remove()
+
+        engine = db.get_engine(app)
+        read_model = ReadModel()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        read_model.reload(engine)
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        rows = len(read_model.actors.records) + \
+            len(read_model.movies.records)
+        print('actors: %d, movies: %d, memory: %.1f MB, %d bytes per row' % (
+            len(read_model.actors.records), len(read_model.movies.records),
+            size / 1e6, size / rows))
+
+        # sync() returns right away while the snapshot is fresh
+        read_model.max_staleness = 1e9
+        window = len(read_model.range('movies', 'release_date', start, end))
+        queries = [
+            ('get actor by id', lambda: get_by_id(Actors, actor_id),
+             lambda: read_model.get('actors', actor_id)),
+            ('list actors', lambda: list_by_id(Actors),
+             lambda: read_model.all('actors')),
+            ('movies of a year', lambda: list_movies_released(start, end),
+             lambda: read_model.range('movies', 'release_date', start, end))
+        ]
+        print('iterations: %d, movies in the year: %d' % (
+            ITERATIONS, window))
+        print('%-18s %12s %12s %9s' % ('query', 'sql us', 'memory us',
+                                       'speedup'))
+        for name, sql_fn, memory_fn in queries:
+            sql = wall_per_call(sql_fn)
+            memory = wall_per_call(
+                lambda: (read_model.sync(engine), memory_fn()))
+            print('%-18s %12.1f %12.1f %8.0fx' % (
+                name, sql, memory, sql / memory))
@@ -0,0 +1,317 @@
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import date
+from dateutil import parser as date_parser
+from sqlalchemy import select, text
+
+import stats
+from models import (db, Actors, Movies, CatalogStats, ImportCheckpoints,
+                    next_change_seqs)
+
+'''
+Bulk import and export of actors and movies (manage.py import / export)
+
+Files are CSV (with a header line) or NDJSON (one JSON object per line)
+and are streamed in batches, so memory use doesn't depend on the file
+size. On Postgres batches are loaded with COPY, on other databases with
+an executemany insert.
+
+Every batch is committed together with its position in the file (in
+the import_checkpoints table), so an interrupted import continues after
+the last committed batch when it is started again.
+'''
+
+TABLES = {
+    'actors': Actors.__table__,
+    'movies': Movies.__table__
+}
+
+# columns a file may contain, in COPY order
+COLUMNS = {
+    'actors': ('id', 'name', 'age', 'gender'),
+    'movies': ('id', 'title', 'release_date')
+}
+
+INTEGER_COLUMNS = ('id', 'age')
+DATE_COLUMNS = ('release_date',)
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def file_format(path, fmt=None):
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    return 'csv'
+
+
+def read_records(stream, fmt):
+    """Yields the records of the file as dicts, one at a time"""
+    if fmt == 'csv':
+        for record in csv.DictReader(stream):
+            yield record
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def convert(column, value):
+    """Converts a value read from a file to its python type, '' is
+    NULL
+    """
+    if value is None or value == '':
+        return None
+    if column in INTEGER_COLUMNS:
+        return int(value)
+    if column in DATE_COLUMNS and not isinstance(value, date):
+        try:
+            return date.fromisoformat(str(value)[:10])
+        except ValueError:
+            return date_parser.parse(str(value)).date()
+    return value
+
+
+class Progress:
+    def __init__(self, label, done=0):
+        self.label = label
+        self.done = done
+        self.start = time.monotonic()
+        self.counted = 0
+
+    def add(self, count, unit='records'):
+        self.done += count
+        self.counted += count
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        sys.stderr.write('\r%s: %d %s (%.0f/s)' % (
+            self.label, self.done, unit, self.counted / elapsed))
+        sys.stderr.flush()
+
+    def finish(self):
+        sys.stderr.write('\n')
+
+
+def copy_rows(connection, table_name, columns, rows):
+    """Loads rows with COPY ... FROM STDIN through the psycopg2 cursor
+    of the connection
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        # None is written as an unquoted empty field, which COPY reads
+        # as NULL
+        writer.writerow(['' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+                table_name, ', '.join(columns)),
+            buffer)
+    finally:
+        cursor.close()
+
+
+def load_batch(connection, table_name, columns, batch):
+    table = TABLES[table_name]
+    rows = [[convert(column, record.get(column)) for column in columns]
+            for record in batch]
+    # imported rows are part of the change feed like any other write
+    columns = list(columns) + ['updated_txid', 'updated_seq']
+    txid, seqs = next_change_seqs(connection, len(rows))
+    for row, seq in zip(rows, seqs):
+        row.extend((txid, seq))
+
+    if connection.dialect.name == 'postgresql':
+        copy_rows(connection, table_name, columns, rows)
+    else:
+        connection.execute(
+            table.insert(), [dict(zip(columns, row)) for row in rows])
+
+    # keep the catalog statistics in step with the new rows
+    deltas = defaultdict(int)
+    for row in rows:
+        values = defaultdict(lambda: None, zip(columns, row))
+        for counter in stats.buckets(table_name, values):
+            deltas[counter] += 1
+    stats.apply_deltas(connection, CatalogStats.__table__, deltas)
+
+
+def checkpoint_position(connection, name):
+    checkpoints = ImportCheckpoints.__table__
+    return connection.scalar(
+        select([checkpoints.c.position]).where(
+            checkpoints.c.name == name)) or 0
+
+
+def save_checkpoint(connection, name, position):
+    checkpoints = ImportCheckpoints.__table__
+    result = connection.execute(
+        checkpoints.update().where(checkpoints.c.name == name).values(
+            position=position))
+    if result.rowcount == 0:
+        connection.execute(
+            checkpoints.insert().values(name=name, position=position))
+
+
+def fix_id_sequence(connection, table_name):
+    # rows with ids from the file don't advance the id sequence
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+        "COALESCE((SELECT MAX(id) FROM %s), 1))" % table_name),
+        table=table_name)
+
+
+def import_file(table_name, path, fmt=None, batch_size=DEFAULT_BATCH_SIZE,
+                name=None, restart=False):
+    """Imports the records of a CSV or NDJSON file into actors or movies.
+    Returns the number of records imported by this run
+    """
+    fmt = file_format(path, fmt)
+    name = name or '%s:%s' % (table_name, os.path.abspath(path))
+    engine = db.engine
+
+    with engine.begin() as connection:
+        if restart:
+            save_checkpoint(connection, name, 0)
+        position = checkpoint_position(connection, name)
+
+    progress = Progress('%s %s' % (table_name, path), position)
+    imported = 0
+    columns = None
+    with open(path, newline='', encoding='utf-8') as stream:
+        records = read_records(stream, fmt)
+        # skip what an earlier run already committed
+        for skipped in range(position):
+            if next(records, None) is None:
+                break
+
+        for batch in batches(records, batch_size):
+            if columns is None:
+                columns = [column for column in COLUMNS[table_name]
+                           if column in batch[0]]
+            with engine.begin() as connection:
+                load_batch(connection, table_name, columns, batch)
+                position += len(batch)
+                save_checkpoint(connection, name, position)
+            imported += len(batch)
+            progress.add(len(batch))
+
+    if columns and 'id' in columns:
+        with engine.begin() as connection:
+            fix_id_sequence(connection, table_name)
+    progress.finish()
+    return imported
+
+
+class CountingWriter:
+    """File wrapper reporting the bytes COPY ... TO STDOUT writes"""
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.pending = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.pending += len(data)
+        if self.pending >= 1 << 20:
+            self.progress.add(self.pending, 'bytes')
+            self.pending = 0
+
+    def flush(self):
+        self.progress.add(self.pending, 'bytes')
+        self.pending = 0
+
+
+def json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def export_file(table_name, path, fmt=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Writes all rows of actors or movies to a CSV or NDJSON file,
+    ordered by id. Returns the number of rows for the batched export
+    """
+    fmt = file_format(path, fmt)
+    table = TABLES[table_name]
+    columns = COLUMNS[table_name]
+    progress = Progress('%s %s' % (table_name, path))
+
+    with db.engine.connect() as connection:
+        if fmt == 'csv' and connection.dialect.name == 'postgresql':
+            copy_out(connection, table_name, columns, path, progress)
+            return None
+        exported = write_rows(connection, table, columns, path, fmt,
+                              batch_size, progress)
+
+    progress.finish()
+    return exported
+
+
+def copy_out(connection, table_name, columns, path, progress):
+    # psycopg2 writes the COPY data as bytes
+    with open(path, 'wb') as stream:
+        writer = CountingWriter(stream, progress)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY (SELECT %s FROM %s ORDER BY id) TO STDOUT '
+                'WITH (FORMAT csv, HEADER)' % (
+                    ', '.join(columns), table_name),
+                writer)
+        finally:
+            cursor.close()
+        writer.flush()
+    progress.finish()
+
+
+def write_rows(connection, table, columns, path, fmt, batch_size, progress):
+    exported = 0
+    # server side cursor on Postgres, rows are fetched batch by batch
+    result = connection.execution_options(stream_results=True).execute(
+        select([table.c[column] for column in columns])
+        .order_by(table.c.id))
+
+    with open(path, 'w', newline='', encoding='utf-8') as stream:
+        writer = csv.writer(stream) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(columns)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if writer is not None:
+                    writer.writerow(
+                        ['' if value is None else value for value in row])
+                else:
+                    stream.write(json.dumps(
+                        {column: json_value(value)
+                         for column, value in zip(columns, row)}) + '\n')
+            exported += len(rows)
+            progress.add(len(rows))
+
+    return exported
@@ -0,0 +1,120 @@
+from sqlalchemy import text, tuple_
+
+from models import db, Tombstones, change_token
+
+'''
+Change feed for actors and movies
+
+Every insert and update stamps the row with the next number of the
+change sequence (updated_seq) and every delete adds a tombstone with
+one. A client keeps the last token it got and asks for
+    GET /actors/changes?since=<token>
+which returns the rows and tombstones after the token, in order, plus
+the token for the next call. Both lookups use the index on
+(updated_txid, updated_seq), so a sync costs as much as the number of
+changes.
+
+Numbers are handed out when a write happens, not when it commits, and
+a transaction can hold them for long: the group commit, a transactional
+/batch or a batch of manage.py import. Ordered by updated_seq alone, a
+transaction that commits late would put a change below a token that was
+already returned, and the client would never see it. So on Postgres
+every change also carries the id of its transaction (updated_txid):
+    - changes are ordered by (updated_txid, updated_seq), the token is
+      "<updated_txid>-<updated_seq>" of the last change returned
+    - only changes of transactions older than the oldest one still in
+      flight are returned (the xmin of the snapshot). Every transaction
+      that commits later has a higher id than that, so it comes after
+      the token
+A long running write holds the feed back until it ends. On SQLite the
+writes are numbered in commit order (see next_change_seqs() in
+models.py) and updated_txid is always 0. Tokens of a single number, as
+returned before updated_txid existed, mean (0, number).
+'''
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+
+def parse_token(token):
+    """Returns the (txid, seq) of a token, None for invalid tokens. A
+    missing token means the beginning of the feed
+    """
+    if token is None or token == '':
+        return 0, 0
+    try:
+        position = tuple(int(part) for part in token.split('-'))
+    except ValueError:
+        return None
+    if len(position) == 1:
+        position = (0,) + position
+    if len(position) != 2 or min(position) < 0:
+        return None
+    return position
+
+
+def in_flight_horizon(connection=None):
+    """Id of the oldest transaction still in flight, None on SQLite.
+    Runs on connection, by default on the database of the feed queries
+    (replicas.py keeps the request on one replica)
+    """
+    if connection is None:
+        connection = db.session
+        dialect = db.session.get_bind().dialect
+    else:
+        dialect = connection.dialect
+    if dialect.name != 'postgresql':
+        return None
+    return connection.execute(text(
+        'SELECT txid_snapshot_xmin(txid_current_snapshot())')).scalar()
+
+
+def after(columns, since):
+    """Condition for the changes after the position since. columns is a
+    model or the columns of its table
+    """
+    return tuple_(columns.updated_txid, columns.updated_seq) > \
+        tuple_(*since)
+
+
+def feed_query(query, columns, since, horizon, limit):
+    query = query.filter(after(columns, since))
+    if horizon is not None:
+        query = query.filter(columns.updated_txid < horizon)
+    return query.order_by(columns.updated_txid, columns.updated_seq) \
+        .limit(limit).all()
+
+
+def change_feed(model, key, since, limit=DEFAULT_LIMIT):
+    """Returns (changes, next_token, has_more) for the changes of model
+    after the position since, a (txid, seq) pair. key is the name of the
+    record in the change ('actor' or 'movie')
+    """
+    table_name = model.__table__.name
+    # before the changes: every transaction below it has ended, so its
+    # changes are visible to the queries below
+    horizon = in_flight_horizon()
+    # limit + 1 of each, to find out whether there are more changes
+    rows = feed_query(model.query, model, since, horizon, limit + 1)
+    tombstones = feed_query(
+        Tombstones.query.filter(Tombstones.entity == table_name),
+        Tombstones, since, horizon, limit + 1)
+
+    merged = sorted(
+        [((row.updated_txid, row.updated_seq), 'upsert', row)
+         for row in rows] +
+        [((tombstone.updated_txid, tombstone.updated_seq), 'delete',
+          tombstone) for tombstone in tombstones],
+        key=lambda change: change[0])
+    has_more = len(merged) > limit
+    merged = merged[:limit]
+
+    changes = []
+    for position, op, record in merged:
+        if op == 'upsert':
+            changes.append({'op': op, key: record.format()})
+        else:
+            changes.append({'op': op, 'id': record.entity_id})
+
+    next_position = merged[-1][0] if merged else since
+    return changes, change_token(*next_position), has_more
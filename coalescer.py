@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+from sqlalchemy import text
+
+import events
+from deadlines import (DeadlineExceeded, current_deadline, deadline_of,
+                       check, limit_statements)
+
+'''
+Group commit for single row writes
+
+With WRITE_COALESCING=true, Actors/Movies insert() and update() don't
+commit their own transaction. The write is handed to the
+WriteCoalescer instead, which collects the writes of concurrent
+requests for WRITE_COALESCING_WINDOW_MS milliseconds and runs them in
+one transaction, so many requests share a single commit (and fsync).
+
+Every write runs inside its own SAVEPOINT: a write that fails is rolled
+back and its error is raised in the request that submitted it, the
+other writes of the batch are still committed.
+
+There is no background thread. The first request that submits a write
+while no batch is being collected becomes the leader, waits for the
+window, and runs the batch for everyone. When the leader is done and
+more writes are queued, it hands the leadership to the oldest waiting
+request.
+
+Every write keeps the deadline of its own request (see deadlines.py):
+the batch runs without the leader's deadline, a write whose request is
+out of time is skipped with DeadlineExceeded and the statements of a
+write are limited to the time its request has left. A request that runs
+out of time while its write is still queued takes it back and gets
+DeadlineExceeded; once the write is part of a running batch it waits
+for the batch.
+'''
+
+WRITE_COALESCING = os.environ.get('WRITE_COALESCING', 'false') == 'true'
+WRITE_COALESCING_WINDOW_MS = float(
+    os.environ.get('WRITE_COALESCING_WINDOW_MS', '2'))
+WRITE_COALESCING_MAX_BATCH = int(
+    os.environ.get('WRITE_COALESCING_MAX_BATCH', '128'))
+
+
+class _Write:
+    __slots__ = ('fn', 'deadline', 'result', 'error', 'done', 'lead')
+
+    def __init__(self, fn, deadline):
+        self.fn = fn
+        # of the submitting request, None for no deadline
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.done = False
+        # set when this write's request has to run the next batch
+        self.lead = False
+
+
+class WriteCoalescer:
+    def __init__(self, engine_getter, window=0.002, max_batch=128):
+        # engine_getter is a callable returning the SQLAlchemy engine
+        self.engine_getter = engine_getter
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = []
+        self.leading = False
+        self.condition = threading.Condition()
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, fn):
+        """Runs fn(connection) as part of the next group commit and
+        returns its result, or raises its error
+        """
+        write = _Write(fn, current_deadline())
+        with self.condition:
+            self.queue.append(write)
+            if self.leading:
+                while not write.done and not write.lead:
+                    self.condition.wait(self._wait_time(write))
+            else:
+                self.leading = True
+                write.lead = True
+
+        if write.lead and not write.done:
+            self._lead()
+
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _wait_time(self, write):
+        """Seconds a waiting write may wait, None for no limit. Raises
+        DeadlineExceeded for a queued write that is out of time
+        """
+        if write.deadline is None:
+            return None
+        seconds = write.deadline - time.monotonic()
+        if seconds > 0:
+            return seconds
+        if write in self.queue:
+            # not taken by a batch yet, nothing was written
+            self.queue.remove(write)
+            raise DeadlineExceeded()
+        # its batch is running, and stops running this write in time
+        return None
+
+    def _lead(self):
+        # give concurrent requests a moment to add their writes
+        time.sleep(self.window)
+        with self.condition:
+            batch = self.queue[:self.max_batch]
+            del self.queue[:self.max_batch]
+
+        try:
+            # the batch doesn't run with the leader's deadline, every
+            # write gets the one of its request
+            with deadline_of(None):
+                self._run(batch)
+        finally:
+            with self.condition:
+                for write in batch:
+                    write.done = True
+                if self.queue:
+                    # the oldest waiting request runs the next batch
+                    self.queue[0].lead = True
+                else:
+                    self.leading = False
+                self.condition.notify_all()
+
+    def _run(self, batch):
+        engine = self.engine_getter()
+        self.batches += 1
+        self.writes += len(batch)
+
+        # pysqlite doesn't support SAVEPOINT properly, so on SQLite every
+        # write gets its own transaction instead
+        if engine.dialect.name == 'sqlite':
+            for write in batch:
+                try:
+                    with deadline_of(write.deadline):
+                        check()
+                        with engine.connect() as connection:
+                            with connection.begin():
+                                write.result = write.fn(connection)
+                            events.publish_committed(connection)
+                except Exception as error:
+                    write.error = error
+            return
+
+        try:
+            with engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    limited = False
+                    for write in batch:
+                        with deadline_of(write.deadline):
+                            limited = self._run_write(
+                                connection, write, limited)
+                    if limited:
+                        # the commit isn't limited by the last write
+                        connection.execute(text(
+                            'SET LOCAL statement_timeout TO DEFAULT'))
+                    transaction.commit()
+                except BaseException:
+                    transaction.rollback()
+                    raise
+                events.publish_committed(connection)
+        except Exception as error:
+            # the commit itself failed, nothing of the batch was written
+            for write in batch:
+                if write.error is None:
+                    write.error = error
+                    write.result = None
+
+    def _run_write(self, connection, write, limited):
+        """Runs one write of the batch in its savepoint, with the
+        deadline of its request. limited tells whether a statement_timeout
+        was set for an earlier write, returns it for the next one
+        """
+        try:
+            if limit_statements(connection):
+                limited = True
+            elif limited:
+                connection.execute(text(
+                    'SET LOCAL statement_timeout TO DEFAULT'))
+                limited = False
+        except DeadlineExceeded as error:
+            write.error = error
+            return limited
+
+        savepoint = connection.begin_nested()
+        try:
+            write.result = write.fn(connection)
+            savepoint.commit()
+        except Exception as error:
+            savepoint.rollback()
+            write.error = error
+        return limited
+
+
+def init_write_coalescing(app, db):
+    """Creates the WriteCoalescer for the app when WRITE_COALESCING is
+    enabled
+    """
+    if not WRITE_COALESCING:
+        app.extensions.pop('coalescer', None)
+        return None
+    coalescer = WriteCoalescer(
+        engine_getter=lambda: db.get_engine(app),
+        window=WRITE_COALESCING_WINDOW_MS / 1000.0,
+        max_batch=WRITE_COALESCING_MAX_BATCH)
+    app.extensions['coalescer'] = coalescer
+    return coalescer
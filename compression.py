@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from flask import request, current_app
+
+# brotli and zstandard are optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Response compression
+
+init_compression() registers an after_request hook that compresses
+response bodies of at least COMPRESS_MIN_SIZE bytes with the best
+encoding the client accepts (Accept-Encoding): zstd or br when the
+zstandard / brotli packages are installed, otherwise gzip.
+
+The list endpoints send the same body to many clients, so compressed
+bodies are kept in a CompressedCache (LRU, at most COMPRESS_CACHE_BYTES)
+keyed by the hash of the uncompressed body and the encoding. Hashing a
+body is much cheaper than compressing it again.
+'''
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '500'))
+# gzip level 1-9, brotli quality 0-11, zstd level 1-22
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL', '3'))
+COMPRESS_CACHE_BYTES = int(
+    os.environ.get('COMPRESS_CACHE_BYTES', str(16 * 1024 * 1024)))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html',
+                          'text/csv')
+
+
+def gzip_compress(data):
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+
+
+def zstd_compress(data):
+    return zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(data)
+
+
+# encodings in order of preference when the client accepts several
+ENCODINGS = OrderedDict()
+if zstandard is not None:
+    ENCODINGS['zstd'] = zstd_compress
+if brotli is not None:
+    ENCODINGS['br'] = brotli_compress
+ENCODINGS['gzip'] = gzip_compress
+
+
+def parse_accept_encoding(header):
+    """Returns {encoding: q} of an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(','):
+        pieces = part.strip().split(';')
+        encoding = pieces[0].strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for parameter in pieces[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding] = q
+    return accepted
+
+
+def choose_encoding(header):
+    """Best supported encoding for an Accept-Encoding header, or None"""
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        # ties keep the earlier (preferred) encoding
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressedCache:
+    def __init__(self, max_bytes=COMPRESS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compress(self, data, encoding):
+        key = (hashlib.sha1(data).digest(), encoding)
+        with self.lock:
+            compressed = self.entries.get(key)
+            if compressed is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed = ENCODINGS[encoding](data)
+
+        if len(compressed) <= self.max_bytes:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = compressed
+                    self.size += len(compressed)
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+        return compressed
+
+
+def compress_response(response, cache):
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code < 200 or response.status_code >= 300 \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+
+    response.set_data(cache.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_compression(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    cache = CompressedCache()
+    app.extensions['compression'] = cache
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, cache)
+
+    return cache
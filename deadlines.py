@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_app_context, current_app
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+'''
+Request deadlines
+
+Every route has a deadline, set by the @deadline(name) decorator when
+the request starts. name is the app config key holding the seconds
+(DEADLINE_READ, DEADLINE_WRITE or DEADLINE_BATCH, set from the
+environment variables of the same name). Whatever the request does
+afterwards gets the time that is left:
+    - each database transaction runs with SET LOCAL statement_timeout
+      (Postgres). SQLite connections have a progress handler that
+      interrupts the running statement once the deadline has passed
+    - fetching the Auth0 signing keys uses it as socket timeout
+A request that runs out of time gets a 504 response and its transaction
+is rolled back, so a slow query can't hold a connection and a worker
+for longer than the deadline of its route.
+
+The sub-requests of a /batch run within the deadline of the batch. The
+group commit (coalescer.py) runs every write with the deadline of the
+request that submitted it.
+'''
+
+DEADLINE_READ = float(os.environ.get('DEADLINE_READ', '5'))
+DEADLINE_WRITE = float(os.environ.get('DEADLINE_WRITE', '10'))
+DEADLINE_BATCH = float(os.environ.get('DEADLINE_BATCH', '30'))
+# SQLite virtual machine instructions between two deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+# error code of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message='The request took too long, please retry'):
+        self.message = message
+
+
+def init_deadlines(app):
+    app.config.setdefault('DEADLINE_READ', DEADLINE_READ)
+    app.config.setdefault('DEADLINE_WRITE', DEADLINE_WRITE)
+    app.config.setdefault('DEADLINE_BATCH', DEADLINE_BATCH)
+
+
+def current_deadline():
+    if not has_app_context():
+        return None
+    return g.get('deadline')
+
+
+def remaining():
+    """Seconds left for the current request, None without deadline"""
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check():
+    """Raises DeadlineExceeded when the current request is out of time"""
+    seconds = remaining()
+    if seconds is not None and seconds <= 0:
+        raise DeadlineExceeded()
+
+
+def timeout(default):
+    """Socket timeout for an outbound call: default, or less if the
+    request has less time left
+    """
+    seconds = remaining()
+    if seconds is None:
+        return default
+    check()
+    return min(default, seconds)
+
+
+@contextmanager
+def deadline_of(value):
+    """Runs the block with the deadline value (None for no deadline)
+    instead of the one of the current request. Used by the group commit,
+    which runs the writes of several requests
+    """
+    if not has_app_context():
+        yield
+        return
+    outer = g.get('deadline')
+    g.deadline = value
+    try:
+        yield
+    finally:
+        g.deadline = outer
+
+
+def limit_statements(connection):
+    """Limits the statements of the transaction to the time the current
+    request has left (Postgres). Returns True when a limit was set
+    """
+    seconds = remaining()
+    if seconds is None or connection.dialect.name != 'postgresql':
+        return False
+    check()
+    # SET LOCAL ends with the transaction, the connection goes back to
+    # the pool without it
+    connection.execute(text(
+        'SET LOCAL statement_timeout = %d' % max(int(seconds * 1000), 1)))
+    return True
+
+
+@event.listens_for(Engine, 'begin')
+def set_statement_timeout(connection):
+    limit_statements(connection)
+
+
+def interrupt_after_deadline():
+    # a non-zero result makes SQLite interrupt the statement
+    seconds = remaining()
+    return 1 if seconds is not None and seconds <= 0 else 0
+
+
+@event.listens_for(Pool, 'connect')
+def set_progress_handler(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.set_progress_handler(
+            interrupt_after_deadline, SQLITE_PROGRESS_STEPS)
+
+
+@event.listens_for(Engine, 'handle_error')
+def raise_deadline_exceeded(context):
+    error = context.original_exception
+    if current_deadline() is None:
+        return
+    if getattr(error, 'pgcode', None) == QUERY_CANCELED or \
+            (isinstance(error, sqlite3.OperationalError) and
+             str(error) == 'interrupted'):
+        raise DeadlineExceeded()
+
+
+'''
+@deadline(name) decorator
+
+Place it directly below @app.route, so the time spent waiting for
+admission counts. A deadline that is already set (a /batch running its
+sub-requests) is only ever shortened.
+'''
+
+
+def deadline(name):
+    def deadline_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            outer = g.get('deadline')
+            g.deadline = time.monotonic() + current_app.config[name]
+            if outer is not None:
+                g.deadline = min(outer, g.deadline)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                g.deadline = outer
+
+        return wrapper
+    return deadline_decorator
@@ -0,0 +1,318 @@
+import itertools
+import json
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+from datetime import date
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool
+
+'''
+Catalog events for the /events server-sent events stream
+
+record_change() in models.py calls queue_event() for every insert,
+update and delete. The event is kept on the database connection until
+the transaction commits and is published to the in-process EventBroker
+only once the commit succeeded (a rolled back write or a failed commit
+publishes nothing). The 'commit' event of the engine runs before the
+DBAPI commit, so it only moves the events aside; publish_committed() is
+called after the commit returned: by the session's after_commit event,
+and by the group commit and the transactional /batch, which commit
+their connection themselves.
+
+With EVENTS_PG_NOTIFY=true (Postgres only) events are sent with
+pg_notify() inside the writing transaction instead. Postgres delivers
+them on commit to every worker, where a listener thread publishes them
+to the local broker, so clients see the writes of all workers.
+
+The broker keeps the last EVENTS_BUFFER events, each encoded once, in a
+ring buffer. A connection only holds its position in that buffer; a
+client that falls further behind gets a 'reset' event and should sync
+with /actors/changes and /movies/changes.
+'''
+
+EVENTS_BUFFER = int(os.environ.get('EVENTS_BUFFER', '1000'))
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', '1000'))
+# threads of a gthread worker that streams never take
+EVENTS_RESERVED_THREADS = int(os.environ.get('EVENTS_RESERVED_THREADS', '2'))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', '15'))
+EVENTS_PG_NOTIFY = os.environ.get('EVENTS_PG_NOTIFY', 'false') == 'true'
+NOTIFY_CHANNEL = 'catalog_events'
+
+# table name -> event prefix and permission needed to receive the event
+ENTITIES = {
+    'actors': ('actor', 'get:actors'),
+    'movies': ('movie', 'get:movies')
+}
+
+
+class CatalogEvent:
+    __slots__ = ('permission', 'data', 'encoded')
+
+    def __init__(self, data):
+        self.data = data
+        self.permission = ENTITIES[data['entity']][1]
+        # encoded once, shared by every connection
+        self.encoded = 'id: %s\nevent: %s\ndata: %s\n\n' % (
+            data['token'], data['type'], json.dumps(data['record']))
+
+
+def json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def event_data(table_name, old, new, token):
+    prefix = ENTITIES[table_name][0]
+    if new is None:
+        kind, record = 'deleted', {'id': old['id']}
+    else:
+        kind = 'created' if old is None else 'updated'
+        record = {column: json_value(value)
+                  for column, value in new.items()
+                  if column not in ('updated_txid', 'updated_seq')}
+    return {
+        'entity': table_name,
+        'type': '%s.%s' % (prefix, kind),
+        'token': token,
+        'record': record
+    }
+
+
+class EventBroker:
+    def __init__(self, size=EVENTS_BUFFER):
+        self.buffer = deque(maxlen=size)
+        # number of the last event published
+        self.last = 0
+        self.subscribers = 0
+        self.max_subscribers = EVENTS_MAX_SUBSCRIBERS
+        self.condition = threading.Condition()
+        self.listener = None
+
+    def publish(self, catalog_event):
+        with self.condition:
+            self.last += 1
+            self.buffer.append(catalog_event)
+            self.condition.notify_all()
+
+    def position(self):
+        return self.last
+
+    def wait(self, position, timeout):
+        """Returns (events, new position, lost) for the events after
+        position, waiting up to timeout seconds for one. lost is True
+        when events after position already left the buffer
+        """
+        with self.condition:
+            if self.last == position:
+                self.condition.wait(timeout)
+            oldest = self.last - len(self.buffer)
+            lost = position < oldest
+            start = max(position, oldest) - oldest
+            events = list(itertools.islice(self.buffer, start, None))
+            return events, self.last, lost
+
+    def full(self):
+        return self.subscribers >= self.max_subscribers
+
+    def limit_to_threads(self, threads):
+        """Under a thread per request server (gunicorn's gthread worker)
+        every stream holds one of the worker's threads until the client
+        disconnects. Keeps EVENTS_RESERVED_THREADS of them for the other
+        requests
+        """
+        self.max_subscribers = max(
+            min(EVENTS_MAX_SUBSCRIBERS, threads - EVENTS_RESERVED_THREADS), 0)
+
+    def subscribe(self):
+        with self.condition:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def ensure_listener(self, engine):
+        """Starts the LISTEN thread of this process when events go
+        through Postgres. Started lazily, so it never runs in a process
+        that forks workers afterwards
+        """
+        if not notify_enabled(engine):
+            return
+        with self.condition:
+            if self.listener is not None and self.listener.is_alive():
+                return
+            self.listener = threading.Thread(
+                target=listen, args=(self, engine), daemon=True)
+            self.listener.start()
+
+
+broker = EventBroker()
+
+
+def notify_enabled(engine_or_connection):
+    return EVENTS_PG_NOTIFY and \
+        engine_or_connection.dialect.name == 'postgresql'
+
+
+def queue_event(connection, table_name, old, new, token):
+    """Called inside the writing transaction"""
+    data = event_data(table_name, old, new, token)
+    if notify_enabled(connection):
+        connection.execute(text('SELECT pg_notify(:channel, :payload)'),
+                           channel=NOTIFY_CHANNEL, payload=json.dumps(data))
+        return
+    connection.info.setdefault('pending_events', []).append(data)
+
+
+# The pending events live on the connection. Savepoints remember how
+# many events were pending when they started, so a rolled back
+# savepoint (a failed write of a group commit) drops its own events
+
+@event.listens_for(Engine, 'savepoint')
+def on_savepoint(connection, name):
+    connection.info.setdefault('savepoint_events', {})[name] = len(
+        connection.info.get('pending_events', []))
+
+
+@event.listens_for(Engine, 'rollback_savepoint')
+def on_rollback_savepoint(connection, name, context):
+    count = connection.info.get('savepoint_events', {}).pop(name, None)
+    if count is not None and 'pending_events' in connection.info:
+        del connection.info['pending_events'][count:]
+
+
+@event.listens_for(Engine, 'commit')
+def on_commit(connection):
+    # runs right before the DBAPI commit, which can still fail
+    connection.info.pop('savepoint_events', None)
+    connection.info['committed_events'] = connection.info.pop(
+        'pending_events', [])
+
+
+def publish_committed(connection):
+    """Publishes the events of the transaction connection just
+    committed. Call it only after the commit returned
+    """
+    for data in connection.info.pop('committed_events', []):
+        broker.publish(CatalogEvent(data))
+
+
+# ORM writes: the session remembers its connections and publishes their
+# events once its commit went through
+
+@event.listens_for(Session, 'after_begin')
+def on_session_begin(session, transaction, connection):
+    session.info.setdefault('event_connections', set()).add(connection)
+
+
+@event.listens_for(Session, 'after_commit')
+def on_session_commit(session):
+    # also runs for savepoints, which have nothing to publish yet
+    for connection in session.info.get('event_connections', ()):
+        publish_committed(connection)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def on_session_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('event_connections', None)
+
+
+@event.listens_for(Engine, 'rollback')
+def on_rollback(connection):
+    connection.info.pop('savepoint_events', None)
+    connection.info.pop('pending_events', None)
+
+
+@event.listens_for(Pool, 'reset')
+def on_reset(dbapi_connection, connection_record):
+    # the pool rolls back connections returned in a transaction
+    connection_record.info.pop('savepoint_events', None)
+    connection_record.info.pop('pending_events', None)
+    connection_record.info.pop('committed_events', None)
+
+
+def listen(events_broker, engine):
+    """LISTEN loop of the listener thread, reconnects on errors"""
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            # the connection belongs to this thread, not to the pool
+            connection.detach()
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN %s' % NOTIFY_CHANNEL)
+            while True:
+                select.select([dbapi_connection], [], [], 5)
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    events_broker.publish(
+                        CatalogEvent(json.loads(notify.payload)))
+        except Exception:
+            print(sys.exc_info())
+            time.sleep(1)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+
+def streams_supported(environ):
+    """A stream holds its thread for as long as the client stays
+    connected. Under a single threaded synchronous server (gunicorn's
+    sync worker) that is the whole worker, which the arbiter kills once
+    it stops answering its heartbeat
+    """
+    if environ.get('wsgi.multithread'):
+        return True
+    # gevent and eventlet workers patch the socket module
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey is not None and \
+            gevent_monkey.is_module_patched('socket'):
+        return True
+    eventlet_patcher = sys.modules.get('eventlet.patcher')
+    return eventlet_patcher is not None and \
+        eventlet_patcher.is_monkey_patched('socket')
+
+
+def stream(events_broker, permissions):
+    """Generator of the text/event-stream body for one connection.
+    The subscriber is only counted once the server started sending the
+    body, and always released by the finally below
+    """
+    if not events_broker.subscribe():
+        # the limit was reached since the request was accepted
+        yield 'retry: 30000\nevent: busy\ndata: {}\n\n'
+        return
+    try:
+        position = events_broker.position()
+        yield 'retry: 3000\n\n'
+        while True:
+            events, position, lost = events_broker.wait(
+                position, EVENTS_HEARTBEAT)
+            if lost:
+                yield 'event: reset\ndata: {}\n\n'
+            if not events:
+                # comment line, keeps proxies from closing the connection
+                yield ': keepalive\n\n'
+                continue
+            for catalog_event in events:
+                if catalog_event.permission in permissions:
+                    yield catalog_event.encoded
+    finally:
+        events_broker.unsubscribe()
@@ -0,0 +1,72 @@
+import gc
+import multiprocessing
+import os
+import sys
+
+'''
+Gunicorn settings, used by the Procfile:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is loaded once in the master and the workers are forked from it
+(preload_app), see prefork.py. Set GUNICORN_PRELOAD=false to have every
+worker load the app itself.
+'''
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', str(multiprocessing.cpu_count() * 2 + 1)))
+# gthread: an /events stream occupies one thread, not the whole worker,
+# and the worker keeps answering the arbiter's heartbeat meanwhile (the
+# sync worker would be killed after timeout seconds)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# half of the threads run requests, the others hold the requests waiting
+# for admission (see admission.py) or /events streams
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true') == 'true'
+
+# No garbage collection in the master: a collection writes to every
+# object it visits, which would copy the shared pages into each worker.
+# The workers turn it back on in post_fork
+gc.disable()
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    import prefork
+    import warmup
+    app = server.app.wsgi()
+    try:
+        warmup.prime(app)
+        warmup.prefetch_keys()
+    except Exception:
+        # every worker warms itself up anyway
+        print(sys.exc_info())
+    # the workers must not inherit open connections
+    prefork.dispose_engines(app)
+    # everything loaded so far is left out of the workers' collections
+    # (Python 3.7+)
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        import prefork
+        prefork.after_fork(server.app.wsgi())
+    gc.enable()
+
+
+def post_worker_init(worker):
+    # runs before the worker accepts its first request
+    import events
+    import warmup
+    from gunicorn.workers.gthread import ThreadWorker
+    if isinstance(worker, ThreadWorker):
+        # every /events stream holds one of the threads
+        events.broker.limit_to_threads(worker.cfg.threads)
+        admission = worker.wsgi.extensions.get('admission')
+        if admission is not None:
+            admission.limit_to_threads(worker.cfg.threads)
+    warmup.warm_up_worker(worker.wsgi)
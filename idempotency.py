@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+from flask import request, abort, make_response, current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from deadlines import remaining, check
+from models import IdempotencyKeys
+
+'''
+Idempotency keys for POST and PATCH
+
+A client that sends an Idempotency-Key header gets the response of the
+first request with that key for every retry, without the handler (and
+the database) being run again. Keys are scoped to the subject of the
+token, the method and the path.
+
+Keys live in the idempotency_keys table of the primary database, so a
+retry gets the stored response whichever worker it lands on. The first
+request claims its key by inserting the row (the primary key makes any
+other insert fail) and stores its response in it once it finished. A
+retry that arrives while the first request is still running waits for
+it, but not past its own deadline (504). Only successful responses are stored, a failed request deletes its
+row and can be retried with the same key.
+
+A claim expires after IDEMPOTENCY_LEASE seconds, in case its worker died
+before finishing the request, a stored response after IDEMPOTENCY_TTL.
+Expired rows and the oldest responses beyond IDEMPOTENCY_MAX_KEYS are
+deleted every IDEMPOTENCY_PURGE seconds.
+'''
+
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', '10000'))
+IDEMPOTENCY_LEASE = float(os.environ.get('IDEMPOTENCY_LEASE', '60'))
+IDEMPOTENCY_PURGE = float(os.environ.get('IDEMPOTENCY_PURGE', '60'))
+# seconds a retry waits for the first request with its key
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', '30'))
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyStore:
+    def __init__(self, engine_getter, ttl=IDEMPOTENCY_TTL,
+                 max_keys=IDEMPOTENCY_MAX_KEYS, lease=IDEMPOTENCY_LEASE,
+                 purge_every=IDEMPOTENCY_PURGE):
+        self.engine_getter = engine_getter
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.lease = lease
+        self.purge_every = purge_every
+        self.purged_at = None
+        self.lock = threading.Lock()
+        self.table = IdempotencyKeys.__table__
+
+    def purge(self, now):
+        """Deletes the expired rows and the oldest stored responses beyond
+        max_keys. A request that is still running is never dropped
+        """
+        table = self.table
+        kept = select([table.c.key]).where(table.c.status.isnot(None)) \
+            .order_by(table.c.expires_at.desc()).offset(self.max_keys)
+        with self.engine_getter().begin() as connection:
+            connection.execute(table.delete().where(table.c.expires_at <= now))
+            connection.execute(table.delete().where(table.c.key.in_(kept)))
+
+    def _purge_due(self, now):
+        with self.lock:
+            if self.purged_at is not None and \
+                    now - self.purged_at < self.purge_every:
+                return False
+            self.purged_at = now
+            return True
+
+    def get(self, key):
+        """The row of key, None when there is none or it expired"""
+        table = self.table
+        with self.engine_getter().connect() as connection:
+            row = connection.execute(
+                table.select().where(table.c.key == key)).first()
+        if row is None or row['expires_at'] <= time.time():
+            return None
+        return row
+
+    def begin(self, key, fingerprint):
+        """Returns (row, claim). The caller has to run the request when
+        claim is not None, and call finish() or abandon() with it
+        afterwards. Otherwise row is the row of the first request
+        """
+        now = time.time()
+        if self._purge_due(now):
+            self.purge(now)
+        table = self.table
+        claim = uuid.uuid4().hex
+        while True:
+            try:
+                with self.engine_getter().begin() as connection:
+                    # an expired row is taken over
+                    connection.execute(table.delete().where(
+                        (table.c.key == key) & (table.c.expires_at <= now)))
+                    connection.execute(table.insert().values(
+                        key=key, fingerprint=fingerprint, claim=claim,
+                        expires_at=now + self.lease))
+                return None, claim
+            except IntegrityError:
+                pass
+            row = self.get(key)
+            if row is not None:
+                return row, None
+            # the first request failed in the meantime, claim it again
+            now = time.time()
+
+    def wait(self, key, timeout):
+        """Polls the row of key until the first request finished or
+        timeout seconds passed. Returns the last row, None when the first
+        request failed
+        """
+        end = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            row = self.get(key)
+            left = end - time.monotonic()
+            if row is None or row['status'] is not None or left <= 0:
+                return row
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 0.2)
+
+    def finish(self, key, claim, response):
+        status, headers, body = response
+        table = self.table
+        with self.engine_getter().begin() as connection:
+            connection.execute(table.update().where(
+                (table.c.key == key) & (table.c.claim == claim)).values(
+                    status=status, headers=json.dumps(headers), body=body,
+                    expires_at=time.time() + self.ttl))
+
+    def abandon(self, key, claim):
+        table = self.table
+        with self.engine_getter().begin() as connection:
+            connection.execute(table.delete().where(
+                (table.c.key == key) & (table.c.claim == claim)))
+
+
+def init_idempotency(app, db):
+    app.extensions['idempotency'] = IdempotencyStore(
+        engine_getter=lambda: db.get_engine(app))
+    return app.extensions['idempotency']
+
+
+def wait_time():
+    """IDEMPOTENCY_WAIT, or less if the request has less time left"""
+    seconds = remaining()
+    if seconds is None:
+        return IDEMPOTENCY_WAIT
+    return max(min(IDEMPOTENCY_WAIT, seconds), 0)
+
+
+def scope_hash(key):
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def request_fingerprint():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+
+def replay(row):
+    response = current_app.response_class(
+        row['body'], status=row['status'],
+        headers=[tuple(header) for header in json.loads(row['headers'])])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+'''
+@idempotent decorator
+
+Place it below @requires_auth, it needs the payload for the subject of
+the token. Requests without an Idempotency-Key header are not changed.
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        store = current_app.extensions.get('idempotency')
+        if not idempotency_key or store is None:
+            return f(payload, *args, **kwargs)
+
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            abort(422, {'message': 'Idempotency-Key is too long'})
+
+        key = scope_hash([payload.get('sub'), request.method, request.path,
+                          idempotency_key])
+        fingerprint = request_fingerprint()
+        row, claim = store.begin(key, fingerprint)
+
+        if claim is None:
+            if row['fingerprint'] != fingerprint:
+                abort(422, {
+                    'message': 'Idempotency-Key was used for a different request'})
+            row = store.wait(key, wait_time())
+            # 504 when out of time
+            check()
+            if row is None:
+                # the first request failed, this one runs instead
+                return wrapper(payload, *args, **kwargs)
+            if row['status'] is None:
+                abort(409, {
+                    'message': 'A request with this Idempotency-Key is in progress'})
+            return replay(row)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            store.abandon(key, claim)
+            raise
+
+        if response.status_code >= 400:
+            store.abandon(key, claim)
+            return response
+
+        store.finish(key, claim, (
+            response.status_code,
+            list(response.headers.items()),
+            response.get_data()))
+        return response
+
+    return wrapper
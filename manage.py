@@ -1,8 +1,8 @@
-from flask_script import Manager
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, rebuild_stats
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +10,113 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def stats():
+    """Recomputes the catalog_stats counters from actors and movies"""
+    with db.engine.begin() as connection:
+        rebuild_stats(connection)
+
+
+class ImportCommand(Command):
+    """Imports actors or movies from a CSV or NDJSON file"""
+
+    option_list = (
+        Option('table', choices=('actors', 'movies')),
+        Option('path'),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'),
+               help='file format, by default taken from the extension'),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=5000, help='records per committed batch'),
+        Option('--name', dest='name',
+               help='checkpoint name, defaults to table and file path'),
+        Option('--restart', dest='restart', action='store_true',
+               help='ignore the checkpoint of an earlier run'),
+    )
+
+    def run(self, table, path, fmt, batch_size, name, restart):
+        import bulk
+        imported = bulk.import_file(table, path, fmt=fmt,
+                                    batch_size=batch_size, name=name,
+                                    restart=restart)
+        print('%d %s imported' % (imported, table))
+
+
+class ExportCommand(Command):
+    """Exports actors or movies to a CSV or NDJSON file"""
+
+    option_list = (
+        Option('table', choices=('actors', 'movies')),
+        Option('path'),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'),
+               help='file format, by default taken from the extension'),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=5000, help='rows fetched per batch'),
+    )
+
+    def run(self, table, path, fmt, batch_size):
+        import bulk
+        bulk.export_file(table, path, fmt=fmt, batch_size=batch_size)
+
+
+manager.add_command('import', ImportCommand())
+manager.add_command('export', ExportCommand())
+
+
+# Range partitioning of movies by release date, see partitions.py
+
+partitions_manager = Manager(usage='Manage the partitions of movies')
+
+
+def run_partitions(fn, *args):
+    import partitions
+    try:
+        with db.engine.begin() as connection:
+            return fn(connection, *args)
+    except partitions.PartitionError as error:
+        print(error)
+
+
+@partitions_manager.option('--interval', dest='interval', default='year',
+                           choices=('year', 'decade'))
+@partitions_manager.option('--ahead', dest='ahead', type=int, default=5,
+                           help='years of partitions to create ahead')
+def convert(interval, ahead):
+    """Converts movies into a table partitioned by release date"""
+    import partitions
+    for name, start, end in run_partitions(
+            partitions.convert, interval, ahead) or []:
+        print('%s  %d - %d' % (name, start, end - 1))
+
+
+@partitions_manager.option('--ahead', dest='ahead', type=int, default=5,
+                           help='years of partitions to create ahead')
+def ensure(ahead):
+    """Creates the partitions for the coming years"""
+    import partitions
+    created = run_partitions(partitions.ensure_partitions, ahead)
+    print('created: %s' % ', '.join(created or []))
+
+
+@partitions_manager.option('before', type=int,
+                           help='detach partitions of movies released '
+                                'before this year')
+def detach(before):
+    """Detaches the partitions of old movies from movies"""
+    import partitions
+    detached = run_partitions(partitions.detach, before)
+    print('detached: %s' % ', '.join(detached or []))
+
+
+@partitions_manager.command
+def show():
+    """Lists the partitions of movies"""
+    import partitions
+    for name, start, end in run_partitions(partitions.partitions) or []:
+        print('%s  %d - %d' % (name, start, end - 1))
+
+
+manager.add_command('partitions', partitions_manager)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,78 @@
+"""add change feed columns to actors and movies
+
+Revision ID: 3f9c2a7d1b04
+Revises: 
+Create Date: 2026-10-19 10:12:31.204566
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import text
+from online_migrations import (is_postgres, run_with_lock_timeout,
+                               create_index_concurrently,
+                               drop_index_concurrently, backfill)
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d1b04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# db.create_all() in setup_db() creates new tables (tombstones,
+# change_counter) and the catalog_change_seq sequence, but not new
+# columns of existing tables. On a database created by create_all() the
+# columns already exist, so they are only added when missing. Rows
+# without updated_seq are numbered, so a full sync (token 0-0) sees them;
+# on SQLite with the change_counter row, which the app keeps using.
+
+
+def number_sqlite_rows(table):
+    """Numbers the rows of table after the changes the change_counter
+    row already handed out, and moves the counter past them (see
+    models.next_change_seqs)
+    """
+    bind = op.get_bind()
+    last = bind.execute(text(
+        'SELECT MAX(id) FROM %s WHERE updated_seq IS NULL' % table)).scalar()
+    if last is None:
+        return
+    base = bind.execute(text('SELECT value FROM change_counter')).scalar()
+    backfill(table, 'updated_seq = %d + id' % (base or 0),
+             'updated_seq IS NULL')
+    if base is None:
+        bind.execute(text(
+            'INSERT INTO change_counter (id, value) VALUES (1, :value)'),
+            value=last)
+    else:
+        bind.execute(text('UPDATE change_counter SET value = :value'),
+                     value=base + last)
+
+
+def upgrade():
+    if is_postgres():
+        op.execute('CREATE SEQUENCE IF NOT EXISTS catalog_change_seq')
+
+    for table in ('actors', 'movies'):
+        if is_postgres():
+            run_with_lock_timeout([
+                'ALTER TABLE %s ADD COLUMN IF NOT EXISTS updated_seq bigint'
+                % table])
+            # existing rows join the change feed, in batches
+            backfill(table, "updated_seq = nextval('catalog_change_seq')",
+                     'updated_seq IS NULL')
+        else:
+            columns = [column['name'] for column in
+                       sa.inspect(op.get_bind()).get_columns(table)]
+            if 'updated_seq' not in columns:
+                op.add_column(table, sa.Column('updated_seq', sa.BigInteger(),
+                                               nullable=True))
+            number_sqlite_rows(table)
+        create_index_concurrently('ix_%s_updated_seq' % table, table,
+                                  ['updated_seq'])
+
+
+def downgrade():
+    for table in ('actors', 'movies'):
+        drop_index_concurrently('ix_%s_updated_seq' % table, table)
+        op.drop_column(table, 'updated_seq')
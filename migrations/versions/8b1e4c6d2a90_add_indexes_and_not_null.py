@@ -0,0 +1,55 @@
+"""add indexes and not null constraints to actors and movies
+
+Revision ID: 8b1e4c6d2a90
+Revises: 3f9c2a7d1b04
+Create Date: 2026-10-19 14:03:52.118804
+
+"""
+from online_migrations import (is_postgres, create_index_concurrently,
+                               drop_index_concurrently, backfill,
+                               set_not_null, drop_not_null)
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e4c6d2a90'
+down_revision = '3f9c2a7d1b04'
+branch_labels = None
+depends_on = None
+
+# Safe to run at full load, see online_migrations.py
+
+INDEXES = [
+    ('ix_actors_name', 'actors', ['name']),
+    ('ix_movies_title', 'movies', ['title']),
+    ('ix_movies_release_date', 'movies', ['release_date'])
+]
+
+# column -> value for rows that are still NULL. The handlers always set
+# these columns, NULLs can only come from old or imported rows
+NOT_NULL = [
+    ('actors', 'name', "''"),
+    ('actors', 'gender', "'unknown'"),
+    ('movies', 'title', "''")
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        create_index_concurrently(name, table, columns)
+
+    assignment = '%s = %s'
+    if is_postgres():
+        # backfilled rows show up in the change feed like any other write
+        assignment += ", updated_seq = nextval('catalog_change_seq')"
+    for table, column, value in NOT_NULL:
+        backfill(table, assignment % (column, value), '%s IS NULL' % column)
+        set_not_null(table, column)
+
+
+def downgrade():
+    for table, column, value in reversed(NOT_NULL):
+        drop_not_null(table, column)
+
+    for name, table, columns in reversed(INDEXES):
+        drop_index_concurrently(name, table)
+
@@ -0,0 +1,40 @@
+"""add version columns to actors and movies
+
+Revision ID: c47d5e1f9a32
+Revises: 8b1e4c6d2a90
+Create Date: 2026-10-19 16:40:05.913377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import is_postgres, run_with_lock_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47d5e1f9a32'
+down_revision = '8b1e4c6d2a90'
+branch_labels = None
+depends_on = None
+
+# Adding a column with a constant default doesn't rewrite the table on
+# Postgres 11+, so this only needs a short lock
+
+
+def upgrade():
+    for table in ('actors', 'movies'):
+        if is_postgres():
+            run_with_lock_timeout([
+                'ALTER TABLE %s ADD COLUMN IF NOT EXISTS version integer '
+                'NOT NULL DEFAULT 1' % table])
+            continue
+
+        columns = [column['name']
+                   for column in sa.inspect(op.get_bind()).get_columns(table)]
+        if 'version' not in columns:
+            op.add_column(table, sa.Column('version', sa.Integer(),
+                                           nullable=False, server_default='1'))
+
+
+def downgrade():
+    for table in ('actors', 'movies'):
+        op.drop_column(table, 'version')
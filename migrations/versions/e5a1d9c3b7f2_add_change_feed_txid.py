@@ -0,0 +1,49 @@
+"""add the writing transaction to the change feed
+
+Revision ID: e5a1d9c3b7f2
+Revises: c47d5e1f9a32
+Create Date: 2026-10-19 18:21:47.503912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from online_migrations import (is_postgres, run_with_lock_timeout,
+                               create_index_concurrently,
+                               drop_index_concurrently)
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1d9c3b7f2'
+down_revision = 'c47d5e1f9a32'
+branch_labels = None
+depends_on = None
+
+# Existing changes get updated_txid 0, so they stay before every new
+# change and old tokens (0, seq) keep their place in the feed (see
+# changes.py). A constant default doesn't rewrite the table on
+# Postgres 11+
+
+TABLES = ('actors', 'movies', 'tombstones')
+
+
+def upgrade():
+    for table in TABLES:
+        if is_postgres():
+            run_with_lock_timeout([
+                'ALTER TABLE %s ADD COLUMN IF NOT EXISTS updated_txid '
+                'bigint NOT NULL DEFAULT 0' % table])
+        else:
+            columns = [column['name'] for column in
+                       sa.inspect(op.get_bind()).get_columns(table)]
+            if 'updated_txid' not in columns:
+                op.add_column(table, sa.Column(
+                    'updated_txid', sa.BigInteger(), nullable=False,
+                    server_default='0'))
+        create_index_concurrently('ix_%s_change_feed' % table, table,
+                                  ['updated_txid', 'updated_seq'])
+
+
+def downgrade():
+    for table in TABLES:
+        drop_index_concurrently('ix_%s_change_feed' % table, table)
+        op.drop_column(table, 'updated_txid')
@@ -1,26 +1,248 @@
-from sqlalchemy import Integer, Column, String, create_engine, Date
+from sqlalchemy import (Integer, BigInteger, Column, String, create_engine,
+                        Date, Float, Text, LargeBinary, Sequence, Index,
+                        inspect, event, select, func, text)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from flask import current_app, g
 from flask_sqlalchemy import SQLAlchemy
 import json
 import os
+import stats
+import events
+from replicas import RoutingSQLAlchemy, init_replicas, note_write
+from coalescer import init_write_coalescing
 
 # obtain the postgres database path from environment variable. This will
 # work in Heroku as well with key config
 database_path = os.environ['DATABASE_URL']
+# optional comma separated list of read replicas of DATABASE_URL
+replica_paths = [path.strip() for path in
+                 os.environ.get('REPLICA_DATABASE_URLS', '').split(',')
+                 if path.strip()]
 
-db = SQLAlchemy()
+# RoutingSQLAlchemy sends the queries of read-only handlers to a replica
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    replica_paths is an optional list of read replica urls
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    init_replicas(app, db, replica_paths or [])
     db.app = app
     db.init_app(app)
     db.create_all()
+    init_stats()
+    # group commit of single row writes, if enabled
+    init_write_coalescing(app, db)
+
+
+'''
+Write hooks
+    record_change() is called for every insert, update and delete of
+    actors and movies, on the connection and inside the transaction of
+    the write. ORM writes call it from mapper events, the group commit
+    helpers below call it directly.
+'''
+
+
+def row_values(record):
+    return {column.name: getattr(record, column.name)
+            for column in record.__table__.columns}
+
+
+def old_row_values(record):
+    # values as they were loaded, before the changes of this flush
+    state = inspect(record)
+    values = {}
+    for column in record.__table__.columns:
+        history = state.attrs[column.name].history
+        if history.deleted:
+            values[column.name] = history.deleted[0]
+        else:
+            values[column.name] = getattr(record, column.name)
+    return values
+
+
+def record_change(connection, table, old, new):
+    stats.apply_change(connection, CatalogStats.__table__, table.name,
+                       old, new)
+    if new is None:
+        # deleted rows leave a tombstone in the change feed
+        stamp = change_stamp(connection)
+        connection.execute(Tombstones.__table__.insert().values(
+            entity=table.name, entity_id=old['id'], **stamp))
+    else:
+        stamp = new
+    # published to /events once the transaction commits
+    events.queue_event(connection, table.name, old, new, change_token(
+        stamp['updated_txid'], stamp['updated_seq']))
+
+
+def next_change_seqs(connection, count=1):
+    """Reserves count numbers of the change feed sequence and returns
+    (txid, seqs). On Postgres they come from the catalog_change_seq
+    sequence and txid is the id of the writing transaction (see
+    changes.py). Elsewhere they come from the single row change_counter
+    table and txid is 0: the counter row stays locked until the commit,
+    so the writes are numbered in commit order
+    """
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text(
+            "SELECT txid_current(), nextval('catalog_change_seq') "
+            "FROM generate_series(1, :count)"), count=count).fetchall()
+        return rows[0][0], [row[1] for row in rows]
+
+    counter = ChangeCounter.__table__
+    result = connection.execute(
+        counter.update().values(value=counter.c.value + count))
+    if result.rowcount == 0:
+        connection.execute(counter.insert().values(id=1, value=count))
+    last = connection.scalar(select([counter.c.value]))
+    return 0, list(range(last - count + 1, last + 1))
+
+
+def change_stamp(connection):
+    """Change feed columns of one written row"""
+    txid, seqs = next_change_seqs(connection)
+    return {'updated_txid': txid, 'updated_seq': seqs[0]}
+
+
+def change_token(txid, seq):
+    """Change feed token of a change, see changes.py"""
+    return '%d-%d' % (txid, seq)
+
+
+def before_write(mapper, connection, target):
+    # every insert and update moves the row to the end of the change feed
+    for column, value in change_stamp(connection).items():
+        setattr(target, column, value)
+
+
+def after_insert(mapper, connection, target):
+    record_change(connection, target.__table__, None, row_values(target))
+
+
+def after_update(mapper, connection, target):
+    record_change(connection, target.__table__, old_row_values(target),
+                  row_values(target))
+
+
+def after_delete(mapper, connection, target):
+    record_change(connection, target.__table__, old_row_values(target),
+                  None)
+
+
+def init_stats():
+    """Fills catalog_stats from the existing rows the first time the
+    app runs against a database
+    """
+    with db.engine.connect() as connection:
+        if connection.scalar(
+                select([func.count()]).select_from(CatalogStats.__table__)):
+            return
+        try:
+            with connection.begin():
+                rebuild_stats(connection)
+        except IntegrityError:
+            # another worker filled the table at the same time
+            pass
+
+
+def rebuild_stats(connection):
+    stats.rebuild(connection, CatalogStats.__table__, Actors.__table__,
+                  Movies.__table__)
+
+
+'''
+Group commit helpers
+    used by insert() and update() of the models when the app has a
+    WriteCoalescer (see coalescer.py). The write runs as a core statement
+    in the coalescer's shared transaction instead of the session.
+'''
+
+
+def write_coalescer():
+    # writes of a transactional /batch stay in the batch's transaction
+    if g.get('db_connection') is not None:
+        return None
+    return current_app.extensions.get('coalescer')
+
+
+def write_and_fetch(connection, statement, table, id):
+    """Runs an insert/update and returns the written row, so the record
+    gets the values as the database stored them (dates, defaults...).
+    None when an update matched no row
+    """
+    if connection.dialect.implicit_returning:
+        return connection.execute(statement.returning(*table.columns)).first()
+    result = connection.execute(statement)
+    if id is None:
+        id = result.inserted_primary_key[0]
+    elif result.rowcount == 0:
+        return None
+    return connection.execute(
+        table.select().where(table.c.id == id)).first()
+
+
+def load_row(record, row):
+    for column in record.__table__.columns:
+        setattr(record, column.name, row[column.name])
+
+
+def coalesced_insert(record):
+    table = record.__table__
+    values = {column.name: getattr(record, column.name)
+              for column in table.columns
+              if getattr(record, column.name) is not None}
+
+    def insert_row(connection):
+        values.update(change_stamp(connection))
+        row = write_and_fetch(
+            connection, table.insert().values(**values), table, None)
+        record_change(connection, table, None, dict(row))
+        return row
+
+    load_row(record, write_coalescer().submit(insert_row))
+    note_write(current_app)
+
+
+def coalesced_update(record):
+    table = record.__table__
+    state = inspect(record)
+    changes = {attr.key: attr.value for attr in state.attrs
+               if attr.history.has_changes()}
+    # the session must not flush these changes a second time
+    db.session.expunge(record)
+    if not changes:
+        return
+
+    # same check as the version_id_col of the mapper: the row is only
+    # updated if nobody changed it since it was loaded
+    current = (table.c.id == record.id) & (table.c.version == record.version)
+
+    def update_row(connection):
+        old = connection.execute(table.select().where(current)).first()
+        if old is None:
+            raise StaleDataError(
+                '%s %s was changed or deleted' % (table.name, record.id))
+        values = dict(changes, **change_stamp(connection))
+        statement = table.update().where(current).values(
+            version=table.c.version + 1, **values)
+        row = write_and_fetch(connection, statement, table, record.id)
+        if row is None:
+            raise StaleDataError(
+                '%s %s was changed or deleted' % (table.name, record.id))
+        record_change(connection, table, dict(old), dict(row))
+        return row
+
+    load_row(record, write_coalescer().submit(update_row))
+    note_write(current_app)
 
 
 # Define the classes associated with Tables
@@ -31,9 +253,19 @@ class Actors(db.Model):
     __tablename__ = 'actors'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, nullable=False, index=True)
     age = Column(Integer)
-    gender = Column(String)
+    gender = Column(String, nullable=False)
+    # position in the change feed, see /actors/changes
+    updated_txid = Column(BigInteger, nullable=False, default=0,
+                          server_default='0')
+    updated_seq = Column(BigInteger, index=True)
+    # incremented by every update, sent as ETag (see versions.py)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        Index('ix_actors_change_feed', 'updated_txid', 'updated_seq'),)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -41,10 +273,16 @@ class Actors(db.Model):
         self.gender = gender
 
     def insert(self):
+        if write_coalescer() is not None:
+            coalesced_insert(self)
+            return
         db.session.add(self)
         db.session.commit()
 
     def update(self):
+        if write_coalescer() is not None:
+            coalesced_update(self)
+            return
         db.session.commit()
 
     def delete(self):
@@ -56,7 +294,8 @@ class Actors(db.Model):
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'version': self.version
         }
 
 # Movie Class with table = movies
@@ -67,18 +306,34 @@ class Movies(db.Model):
     __tablename__ = 'movies'
 
     id = Column(Integer, primary_key=True)
-    title = Column(String)
-    release_date = Column(Date)
+    title = Column(String, nullable=False, index=True)
+    release_date = Column(Date, index=True)
+    # position in the change feed, see /movies/changes
+    updated_txid = Column(BigInteger, nullable=False, default=0,
+                          server_default='0')
+    updated_seq = Column(BigInteger, index=True)
+    # incremented by every update, sent as ETag (see versions.py)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        Index('ix_movies_change_feed', 'updated_txid', 'updated_seq'),)
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
     def insert(self):
+        if write_coalescer() is not None:
+            coalesced_insert(self)
+            return
         db.session.add(self)
         db.session.commit()
 
     def update(self):
+        if write_coalescer() is not None:
+            coalesced_update(self)
+            return
         db.session.commit()
 
     def delete(self):
@@ -89,5 +344,84 @@ class Movies(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': self.release_date,
+            'version': self.version
         }
+
+
+# Catalog statistics, one counter per (metric, bucket). Maintained by
+# record_change(), see stats.py
+
+
+class CatalogStats(db.Model):
+    __tablename__ = 'catalog_stats'
+
+    metric = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Position (number of records committed) of every bulk import, so an
+# interrupted import can continue. See bulk.py
+
+
+class ImportCheckpoints(db.Model):
+    __tablename__ = 'import_checkpoints'
+
+    name = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False, default=0)
+
+
+# Responses of the requests sent with an Idempotency-Key, shared by the
+# workers. key is a hash of the scope of the key, status is NULL while the
+# first request is running. See idempotency.py
+
+
+class IdempotencyKeys(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    # random token of the request that owns the key
+    claim = Column(String, nullable=False)
+    # time.time() seconds
+    expires_at = Column(Float, nullable=False, index=True)
+    status = Column(Integer)
+    headers = Column(Text)
+    body = Column(LargeBinary)
+
+
+# Change feed. Deleted actors and movies are remembered as tombstones;
+# updated_seq comes from catalog_change_seq (Postgres) or change_counter,
+# updated_txid is the writing transaction (see next_change_seqs)
+
+change_seq = Sequence('catalog_change_seq', metadata=db.metadata)
+
+
+class Tombstones(db.Model):
+    __tablename__ = 'tombstones'
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    updated_txid = Column(BigInteger, nullable=False, default=0,
+                          server_default='0')
+    updated_seq = Column(BigInteger, nullable=False, index=True)
+
+    __table_args__ = (
+        Index('ix_tombstones_change_feed', 'updated_txid', 'updated_seq'),)
+
+
+class ChangeCounter(db.Model):
+    __tablename__ = 'change_counter'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+for model in (Actors, Movies):
+    event.listen(model, 'before_insert', before_write)
+    event.listen(model, 'before_update', before_write)
+    event.listen(model, 'after_insert', after_insert)
+    event.listen(model, 'after_update', after_update)
+    event.listen(model, 'after_delete', after_delete)
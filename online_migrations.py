@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+from alembic import op
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+'''
+Helpers for migrations that run while the app is serving traffic
+
+Plain ALTER TABLE / CREATE INDEX on actors or movies hold a lock that
+blocks reads and writes for as long as the statement runs, and a DDL
+statement waiting for a lock blocks everybody queued behind it. On
+Postgres these helpers instead
+
+    - build and drop indexes CONCURRENTLY
+    - add NOT NULL as a NOT VALID check constraint first, validate it
+      without blocking writes, then set NOT NULL without a table scan
+    - backfill in small batches, each its own short transaction, with a
+      pause in between
+    - run every statement with lock_timeout, and retry a few times
+      when the lock isn't granted in time instead of queueing
+
+All of this runs outside the migration's transaction (autocommit), so a
+helper call can't be rolled back with the rest of the migration; the
+helpers are written so that running a migration again continues where
+it stopped. Other databases (SQLite in development) get the plain
+operations.
+'''
+
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '2s')
+MIGRATION_LOCK_RETRIES = int(os.environ.get('MIGRATION_LOCK_RETRIES', '5'))
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '1000'))
+# seconds between two backfill batches
+MIGRATION_BATCH_PAUSE = float(os.environ.get('MIGRATION_BATCH_PAUSE', '0.1'))
+
+# SQLSTATE of "lock not available", raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def lock_timeout_error(error):
+    return getattr(error.orig, 'pgcode', None) == LOCK_NOT_AVAILABLE
+
+
+@contextmanager
+def lock_timeout():
+    """Autocommit connection with lock_timeout set, every statement is
+    a transaction of its own
+    """
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        connection.execute(text(
+            "SET lock_timeout = '%s'" % MIGRATION_LOCK_TIMEOUT))
+        try:
+            yield connection
+        finally:
+            connection.execute(text('RESET lock_timeout'))
+
+
+def retry_lock_timeout(fn, description):
+    """Calls fn, again with a growing pause when it times out waiting
+    for a lock
+    """
+    for attempt in range(MIGRATION_LOCK_RETRIES + 1):
+        try:
+            return fn()
+        except OperationalError as error:
+            if not lock_timeout_error(error) or \
+                    attempt == MIGRATION_LOCK_RETRIES:
+                raise
+            print('lock timeout, retrying: %s' % description)
+            time.sleep(2 ** attempt)
+
+
+def run_with_lock_timeout(statements):
+    with lock_timeout() as connection:
+        for statement in statements:
+            retry_lock_timeout(
+                lambda: connection.execute(text(statement)), statement)
+
+
+def index_state(name):
+    """None if the index doesn't exist, otherwise whether it is valid.
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    """
+    return op.get_bind().execute(text(
+        'SELECT indisvalid FROM pg_index '
+        'JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+        'WHERE pg_class.relname = :name'), name=name).scalar()
+
+
+def create_index_concurrently(name, table, columns, unique=False):
+    if not is_postgres():
+        # create_all() already creates the indexes of a new database
+        indexes = inspect(op.get_bind()).get_indexes(table)
+        if name not in [index['name'] for index in indexes]:
+            op.create_index(name, table, columns, unique=unique)
+        return
+
+    def create():
+        state = index_state(name)
+        if state:
+            return
+        if state is False:
+            connection.execute(text(
+                'DROP INDEX CONCURRENTLY IF EXISTS %s' % name))
+        connection.execute(text(
+            'CREATE %sINDEX CONCURRENTLY %s ON %s (%s)' % (
+                'UNIQUE ' if unique else '', name, table,
+                ', '.join(columns))))
+
+    with lock_timeout() as connection:
+        retry_lock_timeout(create, 'create index %s' % name)
+
+
+def drop_index_concurrently(name, table):
+    if not is_postgres():
+        op.drop_index(name, table_name=table)
+        return
+    run_with_lock_timeout(['DROP INDEX CONCURRENTLY IF EXISTS %s' % name])
+
+
+def backfill(table, assignments, condition, batch_size=None, pause=None):
+    """UPDATE table SET assignments WHERE condition, in batches of
+    batch_size ids. Every batch is a transaction of its own, so row
+    locks are held for one batch only
+    """
+    batch_size = batch_size or MIGRATION_BATCH_SIZE
+    pause = MIGRATION_BATCH_PAUSE if pause is None else pause
+    statement = 'UPDATE %s SET %s WHERE id > :low AND id <= :high AND (%s)' \
+        % (table, assignments, condition)
+
+    if not is_postgres():
+        op.get_bind().execute(text(
+            'UPDATE %s SET %s WHERE %s' % (table, assignments, condition)))
+        return
+
+    with lock_timeout() as connection:
+        low, last = connection.execute(text(
+            'SELECT MIN(id) - 1, MAX(id) FROM %s' % table)).first()
+        updated = 0
+        while last is not None and low < last:
+            high = low + batch_size
+            updated += retry_lock_timeout(
+                lambda: connection.execute(
+                    text(statement), low=low, high=high).rowcount,
+                'backfill of %s' % table)
+            low = high
+            sys.stderr.write('\r%s: %d of %d ids, %d rows updated' % (
+                table, min(low, last), last, updated))
+            sys.stderr.flush()
+            time.sleep(pause)
+        sys.stderr.write('\n')
+
+
+def not_null_constraint(table, column):
+    return '%s_%s_not_null' % (table, column)
+
+
+def set_not_null(table, column):
+    """Makes column NOT NULL without holding an exclusive lock while
+    the table is scanned. Existing NULLs have to be backfilled first
+    """
+    if not is_postgres():
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, nullable=False)
+        return
+
+    constraint = not_null_constraint(table, column)
+    exists = op.get_bind().execute(text(
+        'SELECT 1 FROM pg_constraint WHERE conname = :name'),
+        name=constraint).scalar()
+    statements = []
+    if not exists:
+        # only a short exclusive lock, existing rows aren't checked
+        statements.append(
+            'ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) '
+            'NOT VALID' % (table, constraint, column))
+    # scans the table but lets reads and writes through
+    statements.append(
+        'ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, constraint))
+    if op.get_bind().dialect.server_version_info >= (12,):
+        # Postgres 12+ uses the valid constraint instead of a scan
+        statements.append(
+            'ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (table, column))
+        statements.append(
+            'ALTER TABLE %s DROP CONSTRAINT %s' % (table, constraint))
+    run_with_lock_timeout(statements)
+
+
+def drop_not_null(table, column):
+    if not is_postgres():
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, nullable=True)
+        return
+    run_with_lock_timeout([
+        'ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (
+            table, not_null_constraint(table, column)),
+        'ALTER TABLE %s ALTER COLUMN %s DROP NOT NULL' % (table, column)])
@@ -0,0 +1,236 @@
+import re
+from collections import defaultdict
+from datetime import date
+from sqlalchemy import text
+
+import stats
+from models import Movies, CatalogStats
+
+'''
+Range partitioning of movies by release date (Postgres 11+)
+
+manage.py partitions convert turns movies into a table partitioned by
+release_date with one partition per year (movies_y2020) or per decade
+(movies_d2020), plus movies_default for dates outside every partition.
+The Movies model and the endpoints don't change; queries filtering on
+release_date (GET /movies?release_date_from=...) only scan the
+partitions of the requested window.
+
+Partitions for the coming years are created ahead of time with
+manage.py partitions ensure (run it regularly, e.g. from a scheduler),
+so new movies don't end up in movies_default. Partitions of old movies
+can be detached: the table is kept, but its movies leave the catalog.
+
+On a partitioned table the primary key has to include the partition
+key, so movies gets PRIMARY KEY (id, release_date) and release_date
+becomes NOT NULL. ids still come from movies_id_seq.
+'''
+
+PARENT = 'movies'
+DEFAULT_PARTITION = 'movies_default'
+# years per partition and partition name prefix of each interval
+INTERVALS = {
+    'year': 1,
+    'decade': 10
+}
+PREFIXES = {
+    'y': 'year',
+    'd': 'decade'
+}
+PARTITION_NAME = re.compile(r'^movies_([yd])(\d{4})$')
+# how long convert/ensure/detach wait for their table locks
+LOCK_TIMEOUT = '5s'
+
+
+class PartitionError(Exception):
+    pass
+
+
+def check_postgres(connection):
+    if connection.dialect.name != 'postgresql' or \
+            connection.dialect.server_version_info < (11,):
+        raise PartitionError('Partitioning needs Postgres 11 or newer')
+
+
+def is_partitioned(connection):
+    return connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass(:table))"), table=PARENT).scalar()
+
+
+def partitions(connection):
+    """Returns (name, start year, end year) of the year/decade partitions
+    of movies, ordered by start year
+    """
+    names = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table)"),
+        table=PARENT).fetchall()
+    result = []
+    for (name,) in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            start = int(match.group(2))
+            years = INTERVALS[PREFIXES[match.group(1)]]
+            result.append((name, start, start + years))
+    return sorted(result, key=lambda partition: partition[1])
+
+
+def current_interval(connection):
+    existing = partitions(connection)
+    if not existing:
+        raise PartitionError('movies has no year or decade partitions')
+    return PREFIXES[PARTITION_NAME.match(existing[0][0]).group(1)]
+
+
+def partition_start(year, interval):
+    years = INTERVALS[interval]
+    return year // years * years
+
+
+def partition_name(start, interval):
+    prefix = [prefix for prefix, name in PREFIXES.items()
+              if name == interval][0]
+    return 'movies_%s%d' % (prefix, start)
+
+
+def add_partition(connection, start, interval):
+    """Creates the partition starting in year start. Movies of its range
+    that are in movies_default are moved into it, so it can be attached
+    """
+    name = partition_name(start, interval)
+    low = date(start, 1, 1)
+    high = date(start + INTERVALS[interval], 1, 1)
+    connection.execute(text(
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        % (name, PARENT)))
+    if connection.execute(text(
+            'SELECT to_regclass(:table) IS NOT NULL'),
+            table=DEFAULT_PARTITION).scalar():
+        connection.execute(text(
+            'WITH moved AS (DELETE FROM %s WHERE release_date >= :low '
+            'AND release_date < :high RETURNING *) '
+            'INSERT INTO %s SELECT * FROM moved' % (
+                DEFAULT_PARTITION, name)),
+            low=low, high=high)
+    # creates the indexes of the parent on the partition
+    connection.execute(text(
+        "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM ('%s') TO ('%s')"
+        % (PARENT, name, low.isoformat(), high.isoformat())))
+    return name
+
+
+def ensure_partitions(connection, ahead, interval=None):
+    """Creates the missing partitions up to ahead years from now.
+    Returns the names of the new partitions
+    """
+    check_postgres(connection)
+    if not is_partitioned(connection):
+        raise PartitionError('movies is not partitioned, run convert first')
+    interval = interval or current_interval(connection)
+    connection.execute(text("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT))
+
+    existing = {start for name, start, end in partitions(connection)}
+    years = INTERVALS[interval]
+    # after the newest partition, detached old years stay detached
+    first = max(existing) + years if existing else partition_start(
+        date.today().year, interval)
+    last = partition_start(date.today().year + ahead, interval)
+    return [add_partition(connection, start, interval)
+            for start in range(first, last + 1, years)]
+
+
+def convert(connection, interval, ahead):
+    """Replaces movies with a partitioned table holding the same rows.
+    Reads keep working while the rows are copied, writes wait for the
+    conversion to commit
+    """
+    check_postgres(connection)
+    if is_partitioned(connection):
+        raise PartitionError('movies is already partitioned')
+
+    connection.execute(text("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT))
+    connection.execute(text('LOCK TABLE %s IN SHARE MODE' % PARENT))
+    if connection.execute(text(
+            'SELECT EXISTS (SELECT 1 FROM %s WHERE release_date IS NULL)'
+            % PARENT)).scalar():
+        raise PartitionError(
+            'Movies without release date can\'t be partitioned, '
+            'set their release date first')
+
+    connection.execute(text(
+        'CREATE TABLE movies_partitioned (LIKE %s INCLUDING DEFAULTS '
+        'INCLUDING CONSTRAINTS, PRIMARY KEY (id, release_date)) '
+        'PARTITION BY RANGE (release_date)' % PARENT))
+    connection.execute(text(
+        'CREATE TABLE %s PARTITION OF movies_partitioned DEFAULT'
+        % DEFAULT_PARTITION))
+
+    oldest = connection.execute(text(
+        'SELECT EXTRACT(YEAR FROM MIN(release_date))::int FROM %s'
+        % PARENT)).scalar() or date.today().year
+    last = partition_start(date.today().year + ahead, interval)
+    years = INTERVALS[interval]
+    for start in range(partition_start(oldest, interval), last + 1, years):
+        connection.execute(text(
+            "CREATE TABLE %s PARTITION OF movies_partitioned "
+            "FOR VALUES FROM ('%d-01-01') TO ('%d-01-01')" % (
+                partition_name(start, interval), start, start + years)))
+
+    connection.execute(text(
+        'INSERT INTO movies_partitioned SELECT * FROM %s' % PARENT))
+
+    # keep the id sequence, it belongs to the old table
+    connection.execute(text('ALTER SEQUENCE movies_id_seq OWNED BY NONE'))
+    connection.execute(text('DROP TABLE %s' % PARENT))
+    connection.execute(text(
+        'ALTER TABLE movies_partitioned RENAME TO %s' % PARENT))
+    connection.execute(text(
+        'ALTER TABLE %s RENAME CONSTRAINT movies_partitioned_pkey '
+        'TO movies_pkey' % PARENT))
+    connection.execute(text(
+        'ALTER SEQUENCE movies_id_seq OWNED BY %s.id' % PARENT))
+    # indexes of the model, created on every partition
+    for index in Movies.__table__.indexes:
+        index.create(connection)
+    return partitions(connection)
+
+
+def detach(connection, before_year):
+    """Detaches the partitions of movies released before before_year.
+    The tables are kept (drop them by hand once archived); their movies
+    are removed from the statistics and reported as deleted in the
+    change feed. Returns the names of the detached partitions
+    """
+    check_postgres(connection)
+    if not is_partitioned(connection):
+        raise PartitionError('movies is not partitioned')
+    connection.execute(text("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT))
+
+    detached = []
+    for name, start, end in partitions(connection):
+        if end > before_year:
+            continue
+        connection.execute(text('LOCK TABLE %s IN SHARE MODE' % name))
+
+        deltas = defaultdict(int)
+        rows = connection.execute(text(
+            'SELECT release_date, COUNT(*) FROM %s GROUP BY release_date'
+            % name))
+        for release_date, count in rows:
+            for counter in stats.buckets(
+                    'movies', {'release_date': release_date}):
+                deltas[counter] -= count
+        stats.apply_deltas(connection, CatalogStats.__table__, deltas)
+
+        connection.execute(text(
+            "INSERT INTO tombstones "
+            "(entity, entity_id, updated_txid, updated_seq) "
+            "SELECT 'movies', id, txid_current(), "
+            "nextval('catalog_change_seq') FROM %s"
+            % name))
+        connection.execute(text(
+            'ALTER TABLE %s DETACH PARTITION %s' % (PARENT, name)))
+        detached.append(name)
+    return detached
@@ -0,0 +1,58 @@
+import os
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+import events
+from models import db
+
+'''
+Support for gunicorn's preload_app (see gunicorn.conf.py)
+
+With preload the master process imports app.py once and forks the
+workers from it, so the workers share the memory of the loaded app
+(copy on write) and start without importing anything. The master warms
+up what every worker would otherwise build itself (see warmup.py) and
+then closes its database connections: a connection must never be used
+by two processes. Each worker starts with fresh, empty pools.
+
+The pool listeners below are a second line of defence: a connection
+checked out in another process than the one that opened it is
+discarded instead of used.
+'''
+
+
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        # the pool opens a new connection, the old one is left alone
+        # for the process that owns it
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to process %s, not to %s' % (
+                connection_record.info['pid'], pid))
+
+
+def engines(app):
+    """Engine of DATABASE_URL and of every bind (read replicas)"""
+    keys = [None] + list((app.config.get('SQLALCHEMY_BINDS') or {}).keys())
+    return [db.get_engine(app, bind=key) for key in keys]
+
+
+def dispose_engines(app):
+    for engine in engines(app):
+        engine.dispose()
+
+
+def after_fork(app):
+    """Runs in every worker right after the fork"""
+    # new pools, nothing of the master's pools (connections, locks) is
+    # used by the worker
+    dispose_engines(app)
+    # threads don't survive a fork, the worker starts its own listener
+    events.broker.listener = None
@@ -0,0 +1,75 @@
+import os
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+
+from models import db, Movies
+
+'''
+Baked queries for the hot lookups of the route handlers
+
+Model.query.get(id) and Model.query.order_by(Model.id).all() build a
+new Query and compile its SQL on every request. A baked query is built
+and compiled once per model; later calls only bind the parameters and
+run the cached statement (the bakery is also the compiled cache of the
+statement, per dialect).
+
+The lambdas are part of the cache key, so the model they use is passed
+to bakery() as well, otherwise Actors and Movies would share an entry.
+'''
+
+bakery = baked.bakery(size=200)
+
+# most ids one GET /actors?ids=... or /movies?ids=... may ask for
+LOOKUP_MAX_IDS = int(os.environ.get('LOOKUP_MAX_IDS', '100'))
+
+
+def get_by_id(model, id):
+    """Same as model.query.get(id), including the identity map lookup"""
+    query = bakery(lambda session: session.query(model), model)
+    return query(db.session()).get(id)
+
+
+def _list_by_id(model):
+    query = bakery(lambda session: session.query(model), model)
+    query += lambda q: q.order_by(model.id)
+    return query(db.session())
+
+
+def list_by_id(model):
+    """Same as model.query.order_by(model.id).all()"""
+    return _list_by_id(model).all()
+
+
+def compile_list_by_id(model):
+    """Bakes and compiles the statement of list_by_id(model) but reads a
+    single row. yield_per is applied after the statement was taken from
+    the cache (post criteria), it only changes how the rows are fetched
+    """
+    rows = iter(_list_by_id(model).with_post_criteria(
+        lambda q: q.yield_per(1)))
+    next(rows, None)
+
+
+def list_by_ids(model, ids):
+    """Records with one of the ids, in one query (an expanding IN, so
+    the statement is baked once for any number of ids)
+    """
+    query = bakery(lambda session: session.query(model), model)
+    query += lambda q: q.filter(
+        model.id.in_(bindparam('ids', expanding=True)))
+    return query(db.session()).params(ids=list(ids)).all()
+
+
+def list_movies_released(start, end):
+    """Movies with release_date between start and end (both included,
+    None for no limit), ordered by id. On a partitioned movies table
+    only the partitions of the window are scanned
+    """
+    query = bakery(lambda session: session.query(Movies))
+    if start is not None:
+        query += lambda q: q.filter(
+            Movies.release_date >= bindparam('start'))
+    if end is not None:
+        query += lambda q: q.filter(Movies.release_date <= bindparam('end'))
+    query += lambda q: q.order_by(Movies.id)
+    return query(db.session()).params(start=start, end=end).all()
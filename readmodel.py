@@ -0,0 +1,402 @@
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from flask import g, current_app
+from sqlalchemy import func, select
+
+import events
+from batch import is_subrequest
+from changes import after, in_flight_horizon
+from models import db, Actors, Movies, Tombstones
+from replicas import current_client
+
+'''
+In-memory read model of actors and movies
+
+With READ_MODEL_ENABLED=true every worker keeps a snapshot of both
+tables: one small __slots__ record per row, a sorted array of the ids
+and sorted indexes on name, age, title and release_date. GET /actors and
+GET /movies (also with a release date window) are answered from it with
+bisect, without a database round trip.
+
+The snapshot is kept up to date with the change feed (updated_txid,
+updated_seq and tombstones, see changes.py), read from the primary
+database. Like the feed, the position of the snapshot never passes a
+transaction that is still in flight:
+    - right away when a write was published to this worker's broker
+      since the last sync. Writes of this worker are published when
+      they commit, so the next read sees them. With
+      EVENTS_PG_NOTIFY=true the writes of every worker (this one
+      included) are published by the LISTEN thread of events.py a few
+      milliseconds after their commit; the thread is started by the
+      warm-up of the worker, or by its first read
+    - otherwise when the last sync is older than
+      READ_MODEL_MAX_STALENESS seconds
+    - completely reloaded every READ_MODEL_RELOAD seconds, by a
+      background thread that builds new snapshots and swaps them in.
+      The old ones keep answering meanwhile; until the first load is
+      done the requests read from the database. A failed reload is
+      retried after READ_MODEL_RETRY seconds
+A client that wrote something in the last REPLICA_STICKY_SECONDS and
+the sub-requests of a /batch read from the database.
+
+Records are immutable, a change replaces the record, so the records
+found under the lock can be formatted after releasing it.
+'''
+
+READ_MODEL_ENABLED = os.environ.get('READ_MODEL_ENABLED', 'false') == 'true'
+READ_MODEL_MAX_STALENESS = float(
+    os.environ.get('READ_MODEL_MAX_STALENESS', '1'))
+READ_MODEL_RELOAD = float(os.environ.get('READ_MODEL_RELOAD', '300'))
+READ_MODEL_RETRY = float(os.environ.get('READ_MODEL_RETRY', '5'))
+
+
+class ActorRecord:
+    __slots__ = ('id', 'name', 'age', 'gender', 'version')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.name = row['name']
+        self.age = row['age']
+        self.gender = row['gender']
+        self.version = row['version']
+
+    # same as Actors.format()
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'age': self.age,
+            'gender': self.gender,
+            'version': self.version
+        }
+
+
+class MovieRecord:
+    __slots__ = ('id', 'title', 'release_date', 'version')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.title = row['title']
+        self.release_date = row['release_date']
+        self.version = row['version']
+
+    # same as Movies.format()
+    def format(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'release_date': self.release_date,
+            'version': self.version
+        }
+
+
+class SortedIndex:
+    """(key, id) pairs sorted by key and then id. Rows with a NULL key
+    are left out, they never match a filter
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.ids = array('q')
+
+    def _position(self, key, id):
+        low = bisect_left(self.keys, key)
+        high = bisect_right(self.keys, key, low)
+        return bisect_left(self.ids, id, low, high), high
+
+    def load(self, pairs):
+        pairs = sorted(pair for pair in pairs if pair[0] is not None)
+        self.keys = [key for key, id in pairs]
+        self.ids = array('q', [id for key, id in pairs])
+
+    def add(self, key, id):
+        if key is None:
+            return
+        position, high = self._position(key, id)
+        self.keys.insert(position, key)
+        self.ids.insert(position, id)
+
+    def remove(self, key, id):
+        if key is None:
+            return
+        position, high = self._position(key, id)
+        if position < high and self.ids[position] == id:
+            del self.keys[position]
+            del self.ids[position]
+
+    def range(self, low, high):
+        """ids with low <= key <= high, None for no limit"""
+        start = 0 if low is None else bisect_left(self.keys, low)
+        end = len(self.keys) if high is None else \
+            bisect_right(self.keys, high, start)
+        return self.ids[start:end]
+
+
+class Snapshot:
+    """Records of one table by id, plus the sorted indexes"""
+
+    def __init__(self, model, record_class, indexed):
+        self.table = model.__table__
+        self.record_class = record_class
+        self.records = {}
+        self.ids = array('q')
+        self.indexes = {column: SortedIndex() for column in indexed}
+
+    def load(self, rows):
+        """Replaces the content with rows, indexes are sorted once"""
+        self.records = {}
+        for row in rows:
+            record = self.record_class(row)
+            self.records[record.id] = record
+        self.ids = array('q', sorted(self.records))
+        for column, index in self.indexes.items():
+            index.load((getattr(record, column), record.id)
+                       for record in self.records.values())
+
+    def upsert(self, row):
+        record = self.record_class(row)
+        old = self.records.get(record.id)
+        if old is None:
+            self.ids.insert(bisect_left(self.ids, record.id), record.id)
+        else:
+            for column, index in self.indexes.items():
+                index.remove(getattr(old, column), old.id)
+        self.records[record.id] = record
+        for column, index in self.indexes.items():
+            index.add(getattr(record, column), record.id)
+
+    def delete(self, id):
+        old = self.records.pop(id, None)
+        if old is None:
+            return
+        del self.ids[bisect_left(self.ids, id)]
+        for column, index in self.indexes.items():
+            index.remove(getattr(old, column), id)
+
+    def get(self, id):
+        return self.records.get(id)
+
+    def all(self):
+        """Every record, ordered by id"""
+        records = self.records
+        return [records[id] for id in self.ids]
+
+    def range(self, column, low, high):
+        """Records with low <= column <= high, ordered by id"""
+        records = self.records
+        return [records[id]
+                for id in sorted(self.indexes[column].range(low, high))]
+
+    def equal(self, column, value):
+        # like SQL, NULL equals nothing
+        if value is None:
+            return []
+        return self.range(column, value, value)
+
+
+class ReadModel:
+    def __init__(self, max_staleness=READ_MODEL_MAX_STALENESS,
+                 reload_after=READ_MODEL_RELOAD,
+                 retry_after=READ_MODEL_RETRY):
+        self.max_staleness = max_staleness
+        self.reload_after = reload_after
+        self.retry_after = retry_after
+        self.actors, self.movies = self._new_snapshots()
+        # (updated_txid, updated_seq) the next catch up starts after
+        self.cursor = (0, 0)
+        # broker position and time of the last sync
+        self.position = None
+        self.synced_at = None
+        self.loaded_at = None
+        # lock guards the snapshots, sync_lock the catch ups and swaps
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.reloader = None
+        self.failed_at = None
+        self.reloads = 0
+        self.catch_ups = 0
+
+    def _load_cursor(self, connection):
+        """Cursor of a reload, read before the rows. Postgres: every
+        transaction below the horizon has ended, so the rows have its
+        changes, later ones are applied again by the next catch up.
+        SQLite numbers the writes in commit order (see changes.py)
+        """
+        horizon = in_flight_horizon(connection)
+        if horizon is not None:
+            return horizon, 0
+        seqs = [connection.execute(
+            select([func.max(snapshot.table.c.updated_seq)])).scalar()
+            for snapshot in (self.actors, self.movies)]
+        seqs.append(connection.execute(
+            select([func.max(Tombstones.__table__.c.updated_seq)])).scalar())
+        return 0, max([seq for seq in seqs if seq is not None] or [0])
+
+    def _new_snapshots(self):
+        return (Snapshot(Actors, ActorRecord, ('name', 'age')),
+                Snapshot(Movies, MovieRecord, ('title', 'release_date')))
+
+    def reload(self, engine):
+        """Loads every row into new snapshots and swaps them in. The
+        current snapshots keep answering meanwhile, catch ups included:
+        the new cursor is before their changes, so the next catch up
+        applies them again
+        """
+        now = time.monotonic()
+        position = events.broker.position()
+        actors, movies = self._new_snapshots()
+        with engine.begin() as connection:
+            cursor = self._load_cursor(connection)
+            for snapshot in (actors, movies):
+                snapshot.load(connection.execute(snapshot.table.select()))
+        with self.sync_lock, self.lock:
+            self.actors, self.movies = actors, movies
+            self.cursor = cursor
+            self.loaded_at = now
+            self.position = position
+            self.synced_at = now
+            self.reloads += 1
+
+    def _reload_in_background(self, engine):
+        try:
+            self.reload(engine)
+        except Exception:
+            self.failed_at = time.monotonic()
+            print(sys.exc_info())
+
+    def start_reload(self, engine):
+        """Starts a reload thread, unless one is running or the last
+        one failed less than READ_MODEL_RETRY seconds ago
+        """
+        with self.lock:
+            if self.reloader is not None and self.reloader.is_alive():
+                return
+            if self.failed_at is not None and \
+                    time.monotonic() - self.failed_at < self.retry_after:
+                return
+            self.reloader = threading.Thread(
+                target=self._reload_in_background, args=(engine,),
+                name='read-model-reload', daemon=True)
+            self.reloader.start()
+
+    def _read_changes(self, connection):
+        """Every change after the cursor, in the order of the writes (a
+        row can be updated and deleted), and the horizon
+        """
+        horizon = in_flight_horizon(connection)
+        tombstones = Tombstones.__table__
+        changes = []
+        for snapshot in (self.actors, self.movies):
+            table = snapshot.table
+            for row in connection.execute(
+                    table.select().where(after(table.c, self.cursor))):
+                changes.append(((row['updated_txid'], row['updated_seq']),
+                                snapshot, row, None))
+            for row in connection.execute(tombstones.select().where(
+                    (tombstones.c.entity == table.name) &
+                    after(tombstones.c, self.cursor))):
+                changes.append(((row['updated_txid'], row['updated_seq']),
+                                snapshot, None, row['entity_id']))
+        changes.sort(key=lambda change: change[0])
+        return changes, horizon
+
+    def _apply(self, changes, horizon):
+        """Changes of transactions at or above the horizon are applied as
+        well (a change is the current row or a tombstone, applying it
+        twice does no harm), but the cursor stays below them: a
+        transaction still in flight has a higher id, but may have lower
+        sequence numbers
+        """
+        for position, snapshot, row, deleted_id in changes:
+            if row is None:
+                snapshot.delete(deleted_id)
+            else:
+                snapshot.upsert(row)
+            if horizon is None or position[0] < horizon:
+                self.cursor = position
+        self.catch_ups += 1
+
+    def sync(self, engine):
+        """Brings the snapshot up to date when it may be stale. Returns
+        False while there is no snapshot yet, the first load runs in the
+        background
+        """
+        now = time.monotonic()
+        if self.loaded_at is None or \
+                now - self.loaded_at >= self.reload_after:
+            self.start_reload(engine)
+            if self.loaded_at is None:
+                return False
+        # one catch up at a time, the reads keep going meanwhile
+        with self.sync_lock:
+            position = events.broker.position()
+            if position == self.position and \
+                    now - self.synced_at < self.max_staleness:
+                return True
+            # in a transaction, so the request deadline applies
+            with engine.begin() as connection:
+                changes, horizon = self._read_changes(connection)
+            with self.lock:
+                self._apply(changes, horizon)
+            self.position = position
+            self.synced_at = now
+        return True
+
+    # queries, table_name is 'actors' or 'movies'
+
+    def get(self, table_name, id):
+        with self.lock:
+            return getattr(self, table_name).get(id)
+
+    def all(self, table_name):
+        with self.lock:
+            return getattr(self, table_name).all()
+
+    def range(self, table_name, column, low, high):
+        with self.lock:
+            return getattr(self, table_name).range(column, low, high)
+
+    def equal(self, table_name, column, value):
+        with self.lock:
+            return getattr(self, table_name).equal(column, value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'actors': len(self.actors.records),
+                'movies': len(self.movies.records),
+                'cursor': '%d-%d' % self.cursor,
+                'reloads': self.reloads,
+                'catch_ups': self.catch_ups
+            }
+
+
+def init_read_model(app, enabled=READ_MODEL_ENABLED):
+    """Installs the read model when enabled. It is loaded on first use"""
+    if enabled:
+        app.extensions['read_model'] = ReadModel()
+    return app.extensions.get('read_model')
+
+
+def read_model():
+    """The synced read model, or None when the current request has to
+    read from the database
+    """
+    model = current_app.extensions.get('read_model')
+    if model is None:
+        return None
+    if g.get('db_connection') is not None or is_subrequest():
+        return None
+    router = current_app.extensions.get('replicas')
+    if router is not None and router.recently_wrote(current_client()):
+        return None
+    engine = db.get_engine(current_app)
+    # never started in the gunicorn master, only in the workers
+    events.broker.ensure_listener(engine)
+    if not model.sync(engine):
+        return None
+    return model
@@ -0,0 +1,167 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_app_context, has_request_context, _request_ctx_stack
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+'''
+Read replica routing
+
+setup_db() registers every replica url as a Flask-SQLAlchemy bind named
+replica_<n>. Handlers decorated with @use_replica have their queries
+sent to one of the replicas by RoutingSession.get_bind(), everything
+else (and every flush) goes to the primary DATABASE_URL. A request
+stays on the replica chosen for its first query.
+
+To keep read-your-writes, a client (identified by the subject of its
+JWT) that wrote something is pinned to the primary for
+REPLICA_STICKY_SECONDS afterwards. The pinning is per worker process.
+'''
+
+# Replica selection: 'round_robin' or 'least_connections'
+REPLICA_STRATEGY = os.environ.get('REPLICA_STRATEGY', 'round_robin')
+REPLICA_STICKY_SECONDS = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', '5'))
+# upper bound for the number of recent writers remembered
+MAX_RECENT_WRITERS = 10000
+
+
+def replica_bind_keys(replica_paths):
+    return ['replica_%d' % index for index in range(len(replica_paths))]
+
+
+def current_client():
+    """Subject of the JWT of the current request, if any"""
+    if not has_request_context():
+        return None
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    if not payload:
+        return None
+    return payload.get('sub')
+
+
+class ReplicaRouter:
+    def __init__(self, db, app, bind_keys, strategy=REPLICA_STRATEGY,
+                 sticky_seconds=REPLICA_STICKY_SECONDS):
+        self.db = db
+        self.app = app
+        self.bind_keys = list(bind_keys)
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self.recent_writers = {}
+        self.lock = threading.Lock()
+        self._cycle = itertools.cycle(range(len(self.bind_keys)))
+
+    def engines(self):
+        return [self.db.get_engine(self.app, bind=key)
+                for key in self.bind_keys]
+
+    def choose(self):
+        """Returns the engine of the replica that should serve the next
+        read, or None without replicas
+        """
+        if not self.bind_keys:
+            return None
+
+        if self.strategy == 'least_connections':
+            return min(self.engines(), key=lambda e: e.pool.checkedout())
+
+        with self.lock:
+            index = next(self._cycle)
+        return self.db.get_engine(self.app, bind=self.bind_keys[index])
+
+    def record_write(self, client):
+        if client is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.recent_writers[client] = now
+            if len(self.recent_writers) > MAX_RECENT_WRITERS:
+                # forget everybody whose window has passed
+                self.recent_writers = {
+                    writer: at for writer, at in self.recent_writers.items()
+                    if now - at < self.sticky_seconds}
+
+    def recently_wrote(self, client):
+        if client is None:
+            return False
+        at = self.recent_writers.get(client)
+        return at is not None and time.monotonic() - at < self.sticky_seconds
+
+    def should_use_replica(self):
+        if not self.bind_keys or not has_request_context():
+            return False
+        if not g.get('use_replica') or g.get('db_wrote'):
+            return False
+        return not self.recently_wrote(current_client())
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # a transactional /batch pins the session to its connection
+        if has_app_context() and g.get('db_connection') is not None:
+            return g.db_connection
+        router = self.app.extensions.get('replicas')
+        if router is not None and not self._flushing \
+                and router.should_use_replica():
+            # one replica for the whole request, so all its queries see
+            # the same state (the change feed relies on it)
+            engine = g.get('replica_engine') or router.choose()
+            if engine is not None:
+                g.replica_engine = engine
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def note_write(app):
+    """Called after every write, the client reads from the primary for
+    a while afterwards
+    """
+    if not has_request_context():
+        return
+    g.db_wrote = True
+    router = app.extensions.get('replicas')
+    if router is not None:
+        router.record_write(current_client())
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def remember_write(session, flush_context):
+    note_write(session.app)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app, db, replica_paths):
+    """Registers the replica urls as binds and installs the router"""
+    bind_keys = replica_bind_keys(replica_paths)
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    # drop replicas of an earlier setup_db() call on the same app
+    binds = {key: url for key, url in binds.items()
+             if not key.startswith('replica_')}
+    binds.update(zip(bind_keys, replica_paths))
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['replicas'] = ReplicaRouter(db, app, bind_keys)
+    return app.extensions['replicas']
+
+
+'''
+@use_replica decorator
+
+Marks a read-only handler. Place it below @requires_auth.
+'''
+
+
+def use_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+
+    return wrapper
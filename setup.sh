@@ -3,3 +3,4 @@ export ALGORITHMS='RS256'
 export API_AUDIENCE='casting'
 export DATABASE_URL="postgres://localhost:5432/capstone"
 export TEST_DATABASE_URL="postgres://localhost:5432/test_capstone"
+export REPLICA_DATABASE_URLS=""
@@ -0,0 +1,155 @@
+import os
+import threading
+from functools import wraps
+from flask import request, g, make_response, current_app
+
+from batch import is_subrequest
+from deadlines import remaining, check
+from replicas import current_client
+
+'''
+Single-flight reads
+
+When many identical GET requests arrive at the same time (a burst of
+clients loading the same list), only the first one runs the handler.
+The others wait for it and get a copy of its encoded response, so the
+database runs the query once and the list is serialized once.
+
+Requests are identical when they have the same path, the same query
+parameters and the same permissions in their token. Nothing is kept
+once the first request is done, a request that arrives afterwards runs
+the query again: this is not a cache.
+
+A waiting request never waits past the deadline of its route: it
+answers 504 when the first request is still running by then.
+
+Requests that must see their own writes are never shared: a client
+that wrote something in the last REPLICA_STICKY_SECONDS and the
+sub-requests of a /batch run the handler themselves.
+'''
+
+SINGLE_FLIGHT_ENABLED = os.environ.get(
+    'SINGLE_FLIGHT_ENABLED', 'true') == 'true'
+# seconds a request waits for the first one before running the query
+# itself
+SINGLE_FLIGHT_WAIT = float(os.environ.get('SINGLE_FLIGHT_WAIT', '10'))
+
+
+class _Flight:
+    __slots__ = ('done', 'response')
+
+    def __init__(self):
+        self.done = threading.Event()
+        # (status, headers, body) of the first request, None when it
+        # failed
+        self.response = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        # number of requests that ran the handler / got a copy
+        self.leaders = 0
+        self.followers = 0
+
+    def begin(self, key):
+        """Returns (flight, first). first is True when the caller has to
+        run the request and call finish() afterwards
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = _Flight()
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, key, flight, response):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.response = response
+        flight.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'leaders': self.leaders,
+                'followers': self.followers
+            }
+
+
+def init_single_flight(app):
+    app.extensions['single_flight'] = SingleFlight()
+    return app.extensions['single_flight']
+
+
+def can_share():
+    if is_subrequest() or g.get('db_connection') is not None:
+        return False
+    router = current_app.extensions.get('replicas')
+    return router is None or not router.recently_wrote(current_client())
+
+
+def flight_key(payload):
+    return (request.path,
+            tuple(sorted(request.args.items(multi=True))),
+            tuple(sorted(set(payload.get('permissions', [])))))
+
+
+def wait_time():
+    """SINGLE_FLIGHT_WAIT, or less if the request has less time left"""
+    seconds = remaining()
+    if seconds is None:
+        return SINGLE_FLIGHT_WAIT
+    return max(min(SINGLE_FLIGHT_WAIT, seconds), 0)
+
+
+def shared_response(stored):
+    status, headers, body = stored
+    return current_app.response_class(body, status=status, headers=headers)
+
+
+'''
+@single_flight decorator
+
+Place it below @requires_auth (and @use_replica), it needs the payload
+for the permissions of the token. Only for read-only handlers.
+'''
+
+
+def single_flight(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        flights = current_app.extensions.get('single_flight')
+        if flights is None or not SINGLE_FLIGHT_ENABLED or not can_share():
+            return f(payload, *args, **kwargs)
+
+        key = flight_key(payload)
+        flight, first = flights.begin(key)
+
+        if not first:
+            if flight.done.wait(wait_time()) and \
+                    flight.response is not None:
+                return shared_response(flight.response)
+            # 504 when out of time, otherwise the first request failed or
+            # is too slow: run it here
+            check()
+            return f(payload, *args, **kwargs)
+
+        stored = None
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code < 400:
+                stored = (response.status_code,
+                          list(response.headers.items()),
+                          response.get_data())
+            return response
+        finally:
+            flights.finish(key, flight, stored)
+
+    return wrapper
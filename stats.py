@@ -0,0 +1,147 @@
+from collections import defaultdict
+from datetime import date, datetime
+from dateutil import parser as date_parser
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+'''
+Incrementally maintained catalog statistics
+
+The catalog_stats table (CatalogStats in models.py) holds one counter
+per (metric, bucket):
+
+    actors_by_gender    gender        e.g. ('actors_by_gender', 'female')
+    actors_by_age       age decade    e.g. ('actors_by_age', '20-29')
+    movies_by_year      release year  e.g. ('movies_by_year', '2020')
+
+apply_change() is called by the models for every insert, update and
+delete, inside the transaction of the write, and moves the counters of
+the old row to the buckets of the new row. Reading the statistics is a
+scan of the few counter rows, never of actors or movies.
+'''
+
+UNKNOWN = 'unknown'
+
+
+def age_bucket(age):
+    if age is None:
+        return UNKNOWN
+    try:
+        decade = int(age) // 10 * 10
+    except (TypeError, ValueError):
+        return UNKNOWN
+    return '%d-%d' % (decade, decade + 9)
+
+
+def release_year(release_date):
+    if release_date is None:
+        return UNKNOWN
+    if isinstance(release_date, (date, datetime)):
+        return str(release_date.year)
+    try:
+        # values assigned by the handlers are still the posted strings,
+        # mostly in ISO format
+        return str(date.fromisoformat(str(release_date)[:10]).year)
+    except ValueError:
+        pass
+    try:
+        return str(date_parser.parse(str(release_date)).year)
+    except (ValueError, OverflowError):
+        return UNKNOWN
+
+
+def buckets(table_name, values):
+    """(metric, bucket) counters a row contributes to"""
+    if values is None:
+        return []
+    if table_name == 'actors':
+        return [
+            ('actors_by_gender', values['gender'] or UNKNOWN),
+            ('actors_by_age', age_bucket(values['age']))]
+    if table_name == 'movies':
+        return [('movies_by_year', release_year(values['release_date']))]
+    return []
+
+
+def bump(connection, stats, metric, bucket, delta):
+    if connection.dialect.name == 'postgresql':
+        statement = pg_insert(stats).values(
+            metric=metric, bucket=bucket, count=delta)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[stats.c.metric, stats.c.bucket],
+            set_={'count': stats.c.count + delta}))
+        return
+
+    result = connection.execute(
+        stats.update().where(
+            (stats.c.metric == metric) & (stats.c.bucket == bucket)
+        ).values(count=stats.c.count + delta))
+    if result.rowcount == 0:
+        connection.execute(stats.insert().values(
+            metric=metric, bucket=bucket, count=delta))
+
+
+def apply_change(connection, stats, table_name, old, new):
+    """old/new are the column values of the row before and after the
+    write, None for inserts and deletes respectively
+    """
+    deltas = defaultdict(int)
+    for counter in buckets(table_name, old):
+        deltas[counter] -= 1
+    for counter in buckets(table_name, new):
+        deltas[counter] += 1
+    apply_deltas(connection, stats, deltas)
+
+
+def apply_deltas(connection, stats, deltas):
+    """deltas maps (metric, bucket) to the change of its counter"""
+    # sorted, so concurrent transactions lock the counters in one order
+    for (metric, bucket), delta in sorted(deltas.items()):
+        if delta:
+            bump(connection, stats, metric, bucket, delta)
+
+
+def rebuild(connection, stats, actors, movies):
+    """Recomputes all counters with one scan of actors and movies"""
+    connection.execute(stats.delete())
+
+    counters = defaultdict(int)
+    rows = connection.execute(
+        select([actors.c.gender, actors.c.age, func.count()])
+        .group_by(actors.c.gender, actors.c.age))
+    for gender, age, count in rows:
+        for counter in buckets('actors', {'gender': gender, 'age': age}):
+            counters[counter] += count
+
+    rows = connection.execute(
+        select([movies.c.release_date, func.count()])
+        .group_by(movies.c.release_date))
+    for release_date, count in rows:
+        for counter in buckets('movies', {'release_date': release_date}):
+            counters[counter] += count
+
+    if counters:
+        connection.execute(stats.insert(), [
+            {'metric': metric, 'bucket': bucket, 'count': count}
+            for (metric, bucket), count in sorted(counters.items())])
+
+
+def read(connection, stats):
+    """Returns the statistics in the shape of the /stats endpoint"""
+    result = {
+        'actors': {'total': 0, 'by_gender': {}, 'by_age': {}},
+        'movies': {'total': 0, 'by_release_year': {}}
+    }
+    rows = connection.execute(
+        select([stats.c.metric, stats.c.bucket, stats.c.count])
+        .where(stats.c.count != 0))
+    for metric, bucket, count in rows:
+        if metric == 'actors_by_gender':
+            result['actors']['by_gender'][bucket] = count
+            result['actors']['total'] += count
+        elif metric == 'actors_by_age':
+            result['actors']['by_age'][bucket] = count
+        elif metric == 'movies_by_year':
+            result['movies']['by_release_year'][bucket] = count
+            result['movies']['total'] += count
+    return result
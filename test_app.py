@@ -3,12 +3,54 @@ import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Actors, Movies
+from models import setup_db, db, Actors, Movies, change_stamp
+from changes import parse_token
 # get jwt tokens from the config file to send http requests for
 # authorization in test file.
 from config import jwt_tokens
-from sqlalchemy import desc
+from sqlalchemy import desc, create_engine, event, text
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
 from datetime import date
+from readmodel import init_read_model
+from warmup import start_listener, warm_up_worker, prime
+import queries
+from coalescer import WriteCoalescer
+from deadlines import DeadlineExceeded
+from flask import g
+from admission import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+import events
+import gzip
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+import hashlib
+from jose import jwt
+from idempotency import scope_hash
+import bulk
+import partitions
+import csv
+import tempfile
+import glob
+import re
+import importlib.util
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+# Runs upgrade() or downgrade() of a migration on connection
+
+
+def run_migration(connection, revision, step='upgrade'):
+    path = glob.glob(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'migrations', 'versions', revision + '_*.py'))[0]
+    spec = importlib.util.spec_from_file_location(revision, path)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    with Operations.context(MigrationContext.configure(connection)):
+        getattr(migration, step)()
 
 # Setting up unit tests
 
@@ -421,6 +463,1382 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], "Permission not found")
 
+# Below test checks "error - server busy" for "Get actors" endpoint. All
+# admission slots are taken and no request may queue, so it is shed
+
+    def test_error_503_get_actors(self):
+
+        admission = self.app.extensions['admission']
+        admission.max_concurrency = 1
+        admission.max_queue = {priority: 0 for priority in admission.max_queue}
+        admission.active = 1
+
+        res = self.client().get(
+            '/actors',
+            headers={
+                'Authorization': jwt_tokens['casting_assistant']})
+
+        data = json.loads(res.data)
+        print('\n Test 20: Request shed by admission control')
+        print(data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+# Below test checks read replica routing for "Get actors" endpoint. It needs a
+# second database in TEST_REPLICA_DATABASE_URL which gets an actor that the
+# primary test database doesn't have. Reads go to the replica until the
+# client writes, then the client reads from the primary
+
+    @unittest.skipUnless(
+        os.environ.get('TEST_REPLICA_DATABASE_URL'),
+        'TEST_REPLICA_DATABASE_URL not set')
+    def test_get_actors_from_replica(self):
+
+        replica_path = os.environ['TEST_REPLICA_DATABASE_URL']
+        replica = create_engine(replica_path)
+        Actors.__table__.create(replica, checkfirst=True)
+        replica.execute(Actors.__table__.delete().where(Actors.id == 1000))
+        replica.execute(Actors.__table__.insert().values(
+            id=1000, name='Replica', age=50, gender='female'))
+
+        setup_db(self.app, self.database_path, [replica_path])
+
+        res = self.client().get(
+            '/actors',
+            headers={
+                'Authorization': jwt_tokens['casting_director']})
+
+        data = json.loads(res.data)
+        print('\n Test 21: Actors data from the replica database')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Replica', [actor['name'] for actor in data['actors']])
+
+        res = self.client().post(
+            '/actors',
+            json={"name": "Jess", "age": 30, "gender": "female"},
+            headers={
+                'Authorization': jwt_tokens['casting_director']})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(
+            '/actors',
+            headers={
+                'Authorization': jwt_tokens['casting_director']})
+
+        data = json.loads(res.data)
+        names = [actor['name'] for actor in data['actors']]
+        self.assertIn('Jess', names)
+        self.assertNotIn('Replica', names)
+
+        replica.execute(Actors.__table__.delete().where(Actors.id == 1000))
+        replica.dispose()
+
+# Below test checks "Idempotency-Key" for "Post Actors" endpoint. The retry
+# gets the stored response and no second actor is added
+
+    def test_post_actors_idempotency_key(self):
+
+        new_actor = {
+            "name": "Kate",
+            "age": 33,
+            "gender": "female"
+        }
+        headers = {
+            'Authorization': jwt_tokens['casting_director'],
+            'Idempotency-Key': 'test-post-actors-kate'}
+
+        res = self.client().post('/actors', json=new_actor, headers=headers)
+        first = json.loads(res.data)
+
+        res = self.client().post('/actors', json=new_actor, headers=headers)
+        data = json.loads(res.data)
+        print('\n Test 22: Retry of a post with the same Idempotency-Key')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(data['actor_added']['id'], first['actor_added']['id'])
+
+# Below test checks "success" for "Get stats" endpoint. Adding an actor
+# updates the counters
+
+    def test_get_stats(self):
+
+        headers = {'Authorization': jwt_tokens['executive_producer']}
+        res = self.client().get('/stats', headers=headers)
+        before = json.loads(res.data)
+
+        self.client().post(
+            '/actors',
+            json={"name": "Lena", "age": 61, "gender": "female"},
+            headers=headers)
+
+        res = self.client().get('/stats', headers=headers)
+        data = json.loads(res.data)
+        print('\n Test 23: Catalog statistics')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['actors']['total'],
+                         before['actors']['total'] + 1)
+        self.assertEqual(data['actors']['by_age']['60-69'],
+                         before['actors']['by_age'].get('60-69', 0) + 1)
+        self.assertTrue(data['movies']['total'] > 0)
+
+# Below test checks "success" for "Get actor changes" endpoint. Only the
+# changes after the token are returned, deletes as tombstones
+
+    def test_get_actor_changes(self):
+
+        headers = {'Authorization': jwt_tokens['casting_director']}
+        res = self.client().get('/actors/changes', headers=headers)
+        token = json.loads(res.data)['next_token']
+
+        res = self.client().post(
+            '/actors',
+            json={"name": "Mia", "age": 28, "gender": "female"},
+            headers=headers)
+        actor_id = json.loads(res.data)['actor_added']['id']
+        self.client().delete('/actors/%d' % actor_id, headers=headers)
+
+        res = self.client().get(
+            '/actors/changes?since=%s' % token, headers=headers)
+        data = json.loads(res.data)
+        print('\n Test 24: Actor changes since the last token')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['changes'], [{'op': 'delete', 'id': actor_id}])
+        self.assertTrue(
+            parse_token(data['next_token']) > parse_token(token))
+
+# Below test checks "success" for "Get events" endpoint. A new actor is
+# pushed to the open event stream
+
+    def test_get_events(self):
+
+        res = self.client().get(
+            '/events',
+            headers={'Authorization': jwt_tokens['casting_assistant']},
+            environ_overrides={'wsgi.multithread': True},
+            buffered=False)
+        stream = iter(res.response)
+        next(stream)
+
+        self.client().post(
+            '/actors',
+            json={"name": "Noah", "age": 19, "gender": "male"},
+            headers={'Authorization': jwt_tokens['casting_director']})
+
+        data = next(stream).decode()
+        res.close()
+        print('\n Test 25: Event pushed for a new actor')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('event: actor.created', data)
+        self.assertIn('"name": "Noah"', data)
+
+# Below test checks gzip compression for "Get actors" endpoint. The second
+# response comes from the cache of compressed bodies
+
+    def test_get_actors_gzip(self):
+
+        self.app.config['COMPRESS_MIN_SIZE'] = 10
+        headers = {
+            'Authorization': jwt_tokens['casting_assistant'],
+            'Accept-Encoding': 'gzip'}
+
+        self.client().get('/actors', headers=headers)
+        res = self.client().get('/actors', headers=headers)
+
+        data = json.loads(gzip.decompress(res.data))
+        print('\n Test 26: Gzip compressed actors data')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(data['success'])
+        self.assertEqual(self.app.extensions['compression'].hits, 1)
+
+# Below test checks "success" for "Batch" endpoint. Sub-requests run in
+# order and each one gets its own status and response
+
+    def test_post_batch(self):
+
+        res = self.client().post(
+            '/batch',
+            json={
+                "requests": [
+                    {"method": "POST", "path": "/actors",
+                     "body": {"name": "Ava", "age": 31, "gender": "female"}},
+                    {"method": "GET", "path": "/actors"},
+                    {"method": "DELETE", "path": "/movies/1"}
+                ]
+            },
+            headers={'Authorization': jwt_tokens['casting_director']})
+
+        data = json.loads(res.data)
+        print('\n Test 27: Batch of requests')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['responses'][0]['status'], 200)
+        self.assertIn('Ava', [actor['name'] for actor in
+                              data['responses'][1]['body']['actors']])
+        # casting director can't delete movies
+        self.assertEqual(data['responses'][2]['status'], 401)
+
+# Below test checks that a transactional batch makes no changes when one
+# of its sub-requests fails
+
+    def test_error_422_post_batch_transactional(self):
+
+        res = self.client().post(
+            '/batch',
+            json={
+                "transactional": True,
+                "requests": [
+                    {"method": "POST", "path": "/actors",
+                     "body": {"name": "Liam", "age": 44, "gender": "male"}},
+                    {"method": "PATCH", "path": "/actors/99999",
+                     "body": {"age": 45}}
+                ]
+            },
+            headers={'Authorization': jwt_tokens['casting_director']})
+
+        data = json.loads(res.data)
+        print('\n Test 28: Transactional batch rolled back')
+        print(data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['responses'][1]['status'], 404)
+        with self.app.app_context():
+            self.assertEqual(
+                Actors.query.filter(Actors.name == 'Liam').count(), 0)
+
+# Below test checks "success" for "Get movies" endpoint filtered by
+# release date
+
+    def test_get_movies_release_date(self):
+
+        res = self.client().get(
+            '/movies?release_date_from=2020-10-02&release_date_to=2020-10-03',
+            headers={'Authorization': jwt_tokens['casting_assistant']})
+
+        data = json.loads(res.data)
+        print('\n Test 29: Movies released in a date window')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        with self.app.app_context():
+            expected = Movies.query.filter(
+                Movies.release_date >= date(2020, 10, 2),
+                Movies.release_date <= date(2020, 10, 3)) \
+                .order_by(Movies.id).all()
+            self.assertEqual([movie['id'] for movie in data['movies']],
+                             [movie.id for movie in expected])
+        self.assertTrue(len(data['movies']) < 4)
+
+# Below test checks that "Patch/update Actor" endpoint returns 412 for a
+# stale If-Match header and succeeds with the current ETag
+
+    def test_error_412_patch_actors(self):
+
+        headers = {'Authorization': jwt_tokens['casting_director']}
+        res = self.client().post(
+            '/actors', json={"name": "Mia", "age": 26, "gender": "female"},
+            headers=headers)
+        actor_id = json.loads(res.data)['actor_added']['id']
+        first_etag = res.headers['ETag']
+
+        res = self.client().patch('/actors/%d' % actor_id, json={"age": 27},
+                                  headers=headers)
+        etag = res.headers['ETag']
+
+        stale = self.client().patch(
+            '/actors/%d' % actor_id, json={"age": 28},
+            headers=dict(headers, **{'If-Match': first_etag}))
+        res = self.client().patch(
+            '/actors/%d' % actor_id, json={"age": 29},
+            headers=dict(headers, **{'If-Match': etag}))
+
+        data = json.loads(stale.data)
+        print('\n Test 30: Update of actor with a stale If-Match')
+        print(data)
+
+        self.assertEqual(stale.status_code, 412)
+        self.assertFalse(data['success'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['age'], 29)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+# Below test checks that concurrent identical "Get actors" requests share
+# one database query. The query is slowed down so that the requests overlap
+
+    def test_get_actors_single_flight(self):
+
+        queries = []
+
+        def slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+            if 'FROM actors' in statement:
+                queries.append(statement)
+                time.sleep(0.3)
+
+        responses = []
+
+        def get_actors():
+            responses.append(self.client().get(
+                '/actors',
+                headers={'Authorization': jwt_tokens['casting_assistant']}))
+
+        event.listen(Engine, 'before_cursor_execute', slow_query)
+        try:
+            threads = [threading.Thread(target=get_actors) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', slow_query)
+
+        data = json.loads(responses[0].data)
+        print('\n Test 31: Actors data shared by concurrent requests')
+        print(self.app.extensions['single_flight'].stats())
+
+        self.assertEqual([res.status_code for res in responses], [200] * 8)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(set(res.data for res in responses)), 1)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.app.extensions['single_flight'].followers, 7)
+
+# Below test checks "Get actors" and "Get movies" served by the in-memory
+# read model, which picks up the writes of the same worker
+
+    def test_get_actors_read_model(self):
+
+        read_model = init_read_model(self.app, True)
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+
+        # the first read is answered by the database and loads the read
+        # model in the background
+        first = self.client().get('/actors', headers=headers)
+        read_model.reloader.join(5)
+        self.client().post(
+            '/actors', json={"name": "Leo", "age": 33, "gender": "male"},
+            headers={'Authorization': jwt_tokens['casting_director']})
+        res = self.client().get('/actors', headers=headers)
+        movies = self.client().get(
+            '/movies?release_date_from=2020-10-02', headers=headers)
+
+        data = json.loads(res.data)
+        print('\n Test 32: Actors data from the read model')
+        print(read_model.stats())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        with self.app.app_context():
+            self.assertEqual(
+                data['actors'],
+                [actor.format() for actor in
+                 Actors.query.order_by(Actors.id).all()])
+            expected = Movies.query.filter(
+                Movies.release_date >= date(2020, 10, 2)) \
+                .order_by(Movies.id).all()
+            self.assertEqual(
+                [movie['id'] for movie in json.loads(movies.data)['movies']],
+                [movie.id for movie in expected])
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(data['actors'][-1]['name'], 'Leo')
+        self.assertEqual(read_model.reloads, 1)
+        self.assertTrue(read_model.catch_ups > 0)
+
+# Below test checks that "Get actors" returns 504 when its query runs
+# longer than the deadline of the route
+
+    def test_error_504_get_actors(self):
+
+        self.app.config['DEADLINE_READ'] = 0.2
+
+        def slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+            if 'FROM actors' in statement:
+                statement = (
+                    'WITH RECURSIVE r(n) AS (SELECT 1 UNION ALL '
+                    'SELECT n + 1 FROM r WHERE n < 100000000) '
+                    'SELECT count(*) FROM r')
+            return statement, parameters
+
+        event.listen(Engine, 'before_cursor_execute', slow_query,
+                     retval=True)
+        started = time.monotonic()
+        try:
+            res = self.client().get(
+                '/actors',
+                headers={'Authorization': jwt_tokens['casting_assistant']})
+        finally:
+            event.remove(Engine, 'before_cursor_execute', slow_query)
+
+        data = json.loads(res.data)
+        print('\n Test 33: Actors query past the deadline')
+        print(data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 504)
+        self.assertTrue(time.monotonic() - started < 5)
+
+# Below test checks "success" for "Health" endpoint, it needs no token
+
+    def test_get_healthz(self):
+
+        res = self.client().get('/healthz')
+
+        data = json.loads(res.data)
+        print('\n Test 34: Health of the worker')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['status'], 'alive')
+
+# Below test checks "success" for "Ready" endpoint. The first call starts
+# the warm-up in the background, the next ones only report its state
+
+    def test_get_readyz(self):
+
+        statuses = []
+        for attempt in range(100):
+            res = self.client().get('/readyz')
+            statuses.append(res.status_code)
+            if res.status_code == 200:
+                break
+            time.sleep(0.05)
+
+        data = json.loads(res.data)
+        print('\n Test 35: Readiness of the worker')
+        print(statuses, data)
+
+        warm_up = self.app.extensions['warm_up']
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['status'], 'ready')
+        self.assertTrue(set(statuses) <= {503, 200})
+        self.assertTrue(warm_up.ready)
+        self.assertEqual(warm_up.attempts, 1)
+
+# Below test checks "success" for "Get actors" by ids. Actors come back in
+# the order of the ids, ids without an actor are listed as missing
+
+    def test_get_actors_ids(self):
+
+        with self.app.app_context():
+            first, second = [actor.id for actor in
+                             Actors.query.order_by(Actors.id).limit(2)]
+
+        res = self.client().get(
+            '/actors?ids=%d,999999,%d' % (second, first),
+            headers={'Authorization': jwt_tokens['casting_assistant']})
+
+        data = json.loads(res.data)
+        print('\n Test 36: Actors data by ids')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         [second, first])
+        self.assertEqual(data['missing'], [999999])
+
+# Below test checks that "Get movies" by ids returns 422 for an invalid
+# list of ids
+
+    def test_error_422_get_movies_ids(self):
+
+        res = self.client().get(
+            '/movies?ids=1,two',
+            headers={'Authorization': jwt_tokens['casting_assistant']})
+
+        data = json.loads(res.data)
+        print('\n Test 37: Movies by invalid ids')
+        print(data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+# Below test checks that a write whose commit fails publishes no event,
+# and that the same write publishes one once the commit goes through
+
+    def test_events_not_published_for_failed_commit(self):
+
+        def fail_commit(connection):
+            raise RuntimeError('commit failed')
+
+        headers = {'Authorization': jwt_tokens['casting_director']}
+        body = {"name": "Zoe", "age": 29, "gender": "female"}
+        position = events.broker.position()
+
+        event.listen(Engine, 'commit', fail_commit)
+        try:
+            failed = self.client().post('/actors', json=body, headers=headers)
+        finally:
+            event.remove(Engine, 'commit', fail_commit)
+        failed_position = events.broker.position()
+
+        res = self.client().post('/actors', json=body, headers=headers)
+
+        data = json.loads(failed.data)
+        print('\n Test 38: No event for a failed commit')
+        print(data)
+
+        self.assertEqual(failed.status_code, 422)
+        self.assertEqual(failed_position, position)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(events.broker.position(), position + 1)
+
+# Below test checks that "Get events" is refused by a single threaded
+# server and that a stream whose body is never sent takes no subscriber
+
+    def test_get_events_subscribers(self):
+
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+        subscribers = events.broker.subscribers
+
+        refused = self.client().get('/events', headers=headers)
+        with self.app.test_request_context(
+                '/events', headers=headers,
+                environ_overrides={'wsgi.multithread': True}):
+            res = self.app.full_dispatch_request()
+            unsent = events.broker.subscribers
+            res.close()
+
+        data = json.loads(refused.data)
+        print('\n Test 39: Event streams need a threaded server')
+        print(data)
+
+        self.assertEqual(refused.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(unsent, subscribers)
+        self.assertEqual(events.broker.subscribers, subscribers)
+
+# Below test checks that "Get actor changes" holds back changes that
+# committed while an older transaction was still writing, so the token
+# never passes a change that becomes visible later (Postgres only)
+
+    def test_get_actor_changes_in_flight(self):
+
+        headers = {'Authorization': jwt_tokens['casting_director']}
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+
+        res = self.client().get('/actors/changes', headers=headers)
+        token = json.loads(res.data)['next_token']
+
+        # an open transaction with a change number below the next write
+        connection = engine.connect()
+        transaction = connection.begin()
+        connection.execute(Actors.__table__.insert().values(
+            name='Ida', age=40, gender='female', **change_stamp(connection)))
+        self.client().post(
+            '/actors',
+            json={"name": "Max", "age": 41, "gender": "male"},
+            headers=headers)
+
+        res = self.client().get(
+            '/actors/changes?since=%s' % token, headers=headers)
+        held_back = json.loads(res.data)
+        transaction.commit()
+        connection.close()
+
+        res = self.client().get(
+            '/actors/changes?since=%s' % held_back['next_token'],
+            headers=headers)
+        data = json.loads(res.data)
+        print('\n Test 40: Changes held back while a write is in flight')
+        print(held_back)
+        print(data)
+
+        self.assertEqual(held_back['changes'], [])
+        self.assertEqual(held_back['next_token'], token)
+        self.assertEqual([change['actor']['name']
+                          for change in data['changes']], ['Ida', 'Max'])
+
+# Below test checks that a group commit runs every write with the
+# deadline of its own request: the leader is out of time, the follower
+# still has time, and a follower that runs out of time while its write
+# is queued gets its write back
+
+    def test_group_commit_deadlines(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        coalescer = WriteCoalescer(lambda: engine, window=0.3)
+        results = {}
+
+        def submit(name, seconds):
+            with self.app.app_context():
+                g.deadline = time.monotonic() + seconds
+                try:
+                    results[name] = coalescer.submit(
+                        lambda connection: connection.execute(
+                            text('SELECT 1')).scalar())
+                except DeadlineExceeded as error:
+                    results[name] = error
+
+        threads = [
+            threading.Thread(target=submit, args=('leader', -1)),
+            threading.Thread(target=submit, args=('follower', 5)),
+            threading.Thread(target=submit, args=('queued', 0.1))
+        ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+        print('\n Test 41: Group commit with the deadline of every write')
+        print(results)
+
+        self.assertIsInstance(results['leader'], DeadlineExceeded)
+        self.assertEqual(results['follower'], 1)
+        self.assertIsInstance(results['queued'], DeadlineExceeded)
+        self.assertEqual(coalescer.writes, 2)
+
+# Below test checks that with EVENTS_PG_NOTIFY the read model sees a
+# write once its notification arrived, through the listener started by
+# the warm-up (Postgres only)
+
+    def test_read_model_notify(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+        read_model = init_read_model(self.app, True)
+        # only a notification can trigger the catch up
+        read_model.max_staleness = 60
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+
+        events.EVENTS_PG_NOTIFY = True
+        try:
+            start_listener(self.app)
+            read_model.reload(engine)
+            # give the listener time to run LISTEN
+            time.sleep(0.5)
+            self.client().post(
+                '/actors', json={"name": "Uma", "age": 52, "gender": "female"},
+                headers={'Authorization': jwt_tokens['casting_director']})
+            names = []
+            for attempt in range(40):
+                res = self.client().get('/actors', headers=headers)
+                names = [actor['name']
+                         for actor in json.loads(res.data)['actors']]
+                if 'Uma' in names:
+                    break
+                time.sleep(0.05)
+        finally:
+            events.EVENTS_PG_NOTIFY = False
+        print('\n Test 42: Read model notified of a write')
+        print(read_model.stats())
+
+        self.assertTrue(events.broker.listener.is_alive())
+        self.assertIn('Uma', names)
+
+# Below test checks that bulk work is shed first: with one request running
+# and no queue, the low priority /batch gets a 503 while a write and a
+# read of higher priority are still admitted
+
+    def test_error_503_batch_shed_first(self):
+
+        admission = self.app.extensions['admission']
+        admission.max_concurrency = 4
+        admission.reserve = 2
+        admission.max_queue = {priority: 0 for priority in admission.max_queue}
+        admission.active = 1
+        headers = {'Authorization': jwt_tokens['executive_producer']}
+
+        batch = self.client().post(
+            '/batch',
+            json={"requests": [{"method": "GET", "path": "/actors"}]},
+            headers=headers)
+        write = self.client().post(
+            '/actors', json={"name": "Ava", "age": 36, "gender": "female"},
+            headers=headers)
+        read = self.client().get('/actors', headers=headers)
+
+        data = json.loads(batch.data)
+        print('\n Test 43: Low priority request shed first')
+        print(data, admission.stats())
+
+        self.assertEqual(batch.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(write.status_code, 200)
+        self.assertEqual(read.status_code, 200)
+        self.assertEqual(admission.shed, {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 0,
+                                          PRIORITY_LOW: 1})
+
+# Below test checks that the read model doesn't skip a write that
+# commits after a later one was applied (Postgres only)
+
+    def test_read_model_in_flight(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+        read_model = init_read_model(self.app, True)
+        read_model.max_staleness = 0
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+        read_model.reload(engine)
+
+        # an open transaction with a change number below the next write
+        connection = engine.connect()
+        transaction = connection.begin()
+        connection.execute(Actors.__table__.insert().values(
+            name='Kai', age=44, gender='male', **change_stamp(connection)))
+        self.client().post(
+            '/actors', json={"name": "Rex", "age": 45, "gender": "male"},
+            headers={'Authorization': jwt_tokens['casting_director']})
+        self.client().get('/actors', headers=headers)
+        transaction.commit()
+        connection.close()
+
+        res = self.client().get('/actors', headers=headers)
+        names = [record.name for record in read_model.all('actors')]
+        print('\n Test 44: Read model with a write in flight')
+        print(read_model.stats())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Rex', names)
+        self.assertIn('Kai', names)
+        self.assertEqual(read_model.reloads, 1)
+
+# Below test checks that the read model keeps answering from the old
+# snapshot while a reload waits for the database (Postgres only)
+
+    def test_read_model_background_reload(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+        read_model = init_read_model(self.app, True)
+        read_model.max_staleness = 60
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+        read_model.reload(engine)
+
+        # the reload blocks on the lock until the transaction ends
+        connection = engine.connect()
+        transaction = connection.begin()
+        connection.execute('LOCK TABLE actors IN ACCESS EXCLUSIVE MODE')
+        read_model.reload_after = 0
+        start = time.monotonic()
+        try:
+            res = self.client().get('/actors', headers=headers)
+            seconds = time.monotonic() - start
+            reloading = read_model.reloader.is_alive()
+        finally:
+            transaction.rollback()
+            connection.close()
+        read_model.reloader.join(5)
+        print('\n Test 45: Read model served during a reload')
+        print(read_model.stats())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(json.loads(res.data)['actors'])
+        self.assertTrue(seconds < 1)
+        self.assertTrue(reloading)
+        self.assertEqual(read_model.reloads, 2)
+
+# Below test checks that open event streams leave threads for the other
+# requests of a worker with 4 threads, like gunicorn's gthread worker
+
+    def test_get_events_reserved_threads(self):
+
+        headers = {'Authorization': jwt_tokens['casting_assistant']}
+        closing = threading.Event()
+
+        def request(path):
+            res = self.client().get(
+                path, headers=headers, buffered=False,
+                environ_overrides={'wsgi.multithread': True})
+            if path == '/events':
+                # holds the thread like a connected client
+                for chunk in res.response:
+                    if closing.is_set():
+                        break
+            res.close()
+            return res.status_code
+
+        heartbeat = events.EVENTS_HEARTBEAT
+        events.EVENTS_HEARTBEAT = 0.05
+        events.broker.limit_to_threads(4)
+        worker = ThreadPoolExecutor(4)
+        try:
+            streams = [worker.submit(request, '/events') for i in range(4)]
+            time.sleep(0.5)
+            subscribers = events.broker.subscribers
+            actors = worker.submit(request, '/actors')
+            status = actors.result(5)
+        finally:
+            closing.set()
+            worker.shutdown()
+            events.EVENTS_HEARTBEAT = heartbeat
+            events.broker.max_subscribers = events.EVENTS_MAX_SUBSCRIBERS
+        print('\n Test 46: Requests served while event streams are open')
+        print(subscribers, [stream.result() for stream in streams])
+
+        self.assertEqual(subscribers, 2)
+        self.assertEqual(status, 200)
+
+# Below test checks that a retry with the same Idempotency-Key reaching
+# another worker gets the stored response
+
+    def test_post_actors_idempotency_key_workers(self):
+
+        other_worker = create_app()
+        setup_db(other_worker, self.database_path)
+        new_actor = {"name": "Ines", "age": 28, "gender": "female"}
+        headers = {
+            'Authorization': jwt_tokens['casting_director'],
+            'Idempotency-Key': uuid.uuid4().hex}
+
+        res = self.client().post('/actors', json=new_actor, headers=headers)
+        first = json.loads(res.data)
+        res = other_worker.test_client().post(
+            '/actors', json=new_actor, headers=headers)
+        data = json.loads(res.data)
+        print('\n Test 47: Idempotency-Key retry on another worker')
+        print(data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(data['actor_added']['id'], first['actor_added']['id'])
+
+# Below test checks that the purge of the idempotency keys keeps at most
+# max_keys stored responses, but never drops a request still running
+
+    def test_idempotency_purge(self):
+
+        store = self.app.extensions['idempotency']
+        store.max_keys = 1
+        running = uuid.uuid4().hex
+        store.begin(running, 'fingerprint')
+        keys = [uuid.uuid4().hex for i in range(3)]
+        for key in keys:
+            row, claim = store.begin(key, 'fingerprint')
+            store.finish(key, claim, (200, [], b'{}'))
+            # the stored responses expire in this order
+            time.sleep(0.01)
+        store.purge(time.time())
+        print('\n Test 48: Idempotency keys purged')
+
+        self.assertIsNotNone(store.get(running))
+        self.assertIsNone(store.get(keys[0]))
+        self.assertIsNone(store.get(keys[1]))
+        self.assertEqual(store.get(keys[2])['status'], 200)
+
+# Below test checks that a worker stops waiting for a warm-up that hangs
+# after the timeout, not ready yet
+
+    def test_warm_up_worker_timeout(self):
+
+        warm_up = self.app.extensions['warm_up']
+        # a first attempt that never ends
+        warm_up.thread = threading.Thread(target=lambda: None)
+        start = time.monotonic()
+        ready = warm_up_worker(self.app, timeout=0.2)
+        seconds = time.monotonic() - start
+        print('\n Test 49: Warm-up wait bounded')
+        print(ready, seconds)
+
+        self.assertFalse(ready)
+        self.assertTrue(seconds < 1)
+
+# Below test checks that the warm-up bakes the statement of the full lists
+# of "Get actors" and "Get movies", so the first request adds nothing
+
+    def test_prime_bakes_lists(self):
+
+        prime(self.app)
+        cache = queries.bakery(lambda session: None)._bakery
+        baked = len(cache)
+        res = self.client().get(
+            '/actors', headers={'Authorization': jwt_tokens['casting_assistant']})
+        self.client().get(
+            '/movies', headers={'Authorization': jwt_tokens['casting_assistant']})
+        print('\n Test 50: Full lists baked by the warm-up')
+        print(baked, len(cache))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(cache), baked)
+
+# Below test checks that a request waiting for an identical running one
+# answers 504 at its own deadline instead of waiting longer
+
+    def test_get_actors_single_flight_deadline(self):
+
+        self.app.config['DEADLINE_READ'] = 0.3
+
+        def slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+            if 'FROM actors' in statement:
+                time.sleep(1)
+
+        def get_actors():
+            start = time.monotonic()
+            res = self.client().get(
+                '/actors',
+                headers={'Authorization': jwt_tokens['casting_assistant']})
+            return res, time.monotonic() - start
+
+        event.listen(Engine, 'before_cursor_execute', slow_query)
+        worker = ThreadPoolExecutor(2)
+        try:
+            first = worker.submit(get_actors)
+            time.sleep(0.1)
+            res, seconds = worker.submit(get_actors).result()
+            first.result()
+        finally:
+            worker.shutdown()
+            event.remove(Engine, 'before_cursor_execute', slow_query)
+
+        data = json.loads(res.data)
+        print('\n Test 51: Waiting request answers at its deadline')
+        print(seconds, data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(seconds < 0.8)
+        self.assertEqual(self.app.extensions['single_flight'].followers, 1)
+
+# Below test checks that a retry waiting for the first request with its
+# Idempotency-Key answers 504 at its own deadline
+
+    def test_post_actors_idempotency_key_deadline(self):
+
+        self.app.config['DEADLINE_WRITE'] = 0.3
+        token = jwt_tokens['casting_director']
+        idempotency_key = uuid.uuid4().hex
+        body = json.dumps({"name": "Ada", "age": 36, "gender": "female"})
+        # the first request, still running on another worker
+        store = self.app.extensions['idempotency']
+        store.begin(
+            scope_hash([jwt.get_unverified_claims(token.split()[1])['sub'],
+                        'POST', '/actors', idempotency_key]),
+            hashlib.sha256(body.encode()).hexdigest())
+
+        start = time.monotonic()
+        res = self.client().post(
+            '/actors', data=body, content_type='application/json',
+            headers={'Authorization': token,
+                     'Idempotency-Key': idempotency_key})
+        seconds = time.monotonic() - start
+        data = json.loads(res.data)
+        print('\n Test 52: Idempotency-Key retry answers at its deadline')
+        print(seconds, data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(seconds < 0.8)
+
+# Below test checks that a worker with 4 threads runs at most 2 requests
+# at a time, the other threads hold requests that wait and are shed
+
+    def test_admission_worker_threads(self):
+
+        admission = self.app.extensions['admission']
+        admission.limit_to_threads(4)
+        admission.queue_timeout = {
+            priority: 0.1 for priority in admission.queue_timeout}
+
+        def slow_query(conn, cursor, statement, parameters, context,
+                       executemany):
+            if 'FROM actors' in statement:
+                time.sleep(0.5)
+
+        def get_actors(number):
+            # distinct requests, single-flight doesn't share them
+            return self.client().get(
+                '/actors?ids=%d' % number,
+                headers={'Authorization': jwt_tokens['casting_assistant']})
+
+        event.listen(Engine, 'before_cursor_execute', slow_query)
+        worker = ThreadPoolExecutor(4)
+        try:
+            responses = list(worker.map(get_actors, range(1, 5)))
+        finally:
+            worker.shutdown()
+            event.remove(Engine, 'before_cursor_execute', slow_query)
+        statuses = sorted(res.status_code for res in responses)
+        print('\n Test 53: Admission limit from the worker threads')
+        print(statuses, admission.stats())
+
+        self.assertEqual(admission.limit(), 2)
+        self.assertEqual(statuses, [200, 200, 503, 503])
+
+# Below test checks the bulk import of a CSV file of actors. The first run
+# fails on a bad record in its second batch, the second run continues after
+# the committed batch. COPY on Postgres, executemany on SQLite
+
+    def test_import_actors_csv(self):
+
+        headers = {'Authorization': jwt_tokens['executive_producer']}
+        before = json.loads(self.client().get('/stats', headers=headers).data)
+        with self.app.app_context():
+            first_id = db.session.query(db.func.max(Actors.id)).scalar() + 1000
+            count = Actors.query.count()
+        records = [[first_id + number, 'Import %d' % number, 20 + number,
+                    'female'] for number in range(5)]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'actors.csv')
+
+        def write_file(bad_age):
+            with open(path, 'w', newline='') as stream:
+                writer = csv.writer(stream)
+                writer.writerow(['id', 'name', 'age', 'gender'])
+                for record in records:
+                    writer.writerow(record[:2] + [
+                        bad_age if record is records[3] else record[2],
+                        record[3]])
+
+        name = uuid.uuid4().hex
+        write_file('twenty')
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                bulk.import_file('actors', path, batch_size=2, name=name)
+            interrupted = Actors.query.count()
+            db.session.remove()
+            write_file(records[3][2])
+            imported = bulk.import_file('actors', path, batch_size=2,
+                                        name=name)
+            names = [actor.name for actor in Actors.query.filter(
+                Actors.id >= first_id).order_by(Actors.id)]
+            total = Actors.query.count()
+            db.session.remove()
+
+        after = json.loads(self.client().get('/stats', headers=headers).data)
+        res = self.client().post(
+            '/actors', json={"name": "Next", "age": 30, "gender": "male"},
+            headers=headers)
+        print('\n Test 54: Actors imported from a CSV file')
+        print(interrupted - count, imported, names)
+
+        self.assertEqual(interrupted, count + 2)
+        self.assertEqual(imported, 3)
+        self.assertEqual(total, count + 5)
+        self.assertEqual(names, [record[1] for record in records])
+        self.assertEqual(after['actors']['total'],
+                         before['actors']['total'] + 5)
+        # the id sequence was moved past the imported ids
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(
+            json.loads(res.data)['actor_added']['id'] > records[-1][0])
+
+# Below test checks the bulk import of a NDJSON file of movies and the
+# export of movies to CSV and NDJSON
+
+    def test_import_export_movies(self):
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'movies.ndjson')
+        with open(path, 'w') as stream:
+            for number in range(3):
+                stream.write(json.dumps({
+                    'title': 'Imported %d' % number,
+                    'release_date': '2019-0%d-15' % (number + 1)}) + '\n')
+        exported = {}
+
+        with self.app.app_context():
+            count = Movies.query.count()
+            imported = bulk.import_file('movies', path,
+                                        name=uuid.uuid4().hex)
+            expected = [[movie.id, movie.title,
+                         movie.release_date.isoformat()]
+                        for movie in Movies.query.order_by(Movies.id)]
+            db.session.remove()
+            for fmt in ('csv', 'ndjson'):
+                exported[fmt] = os.path.join(directory, 'export.' + fmt)
+                bulk.export_file('movies', exported[fmt])
+
+        with open(exported['csv'], newline='') as stream:
+            rows = list(csv.reader(stream))
+        with open(exported['ndjson']) as stream:
+            records = [json.loads(line) for line in stream]
+        print('\n Test 55: Movies imported from NDJSON and exported')
+        print(imported, rows[0], records[-1])
+
+        self.assertEqual(imported, 3)
+        self.assertEqual(len(expected), count + 3)
+        self.assertEqual(expected[-1][1:], ['Imported 2', '2019-03-15'])
+        self.assertEqual(rows[0], ['id', 'title', 'release_date'])
+        self.assertEqual([[int(row[0])] + row[1:] for row in rows[1:]],
+                         expected)
+        self.assertEqual(
+            [[record['id'], record['title'], record['release_date']]
+             for record in records], expected)
+
+# Below test checks the group commit of concurrent Actors.insert() calls:
+# every caller gets its own actor, the inserts run as one batch (one
+# transaction on Postgres) and an insert that violates NOT NULL only fails
+# its own caller
+
+    def test_group_commit_inserts(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        coalescer = WriteCoalescer(lambda: engine, window=0.3)
+        self.app.extensions['coalescer'] = coalescer
+        results = {}
+
+        def insert(name):
+            with self.app.test_request_context():
+                actor = Actors(name=name, age=40, gender='female')
+                try:
+                    actor.insert()
+                    results[name] = actor.id
+                except IntegrityError as error:
+                    results[name] = error
+                db.session.remove()
+
+        names = ['Group %d' % number for number in range(4)] + [None]
+        threads = [threading.Thread(target=insert, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = [results[name] for name in names[:4]]
+        with self.app.app_context():
+            rows = Actors.query.filter(Actors.id.in_(ids)).all()
+            db.session.remove()
+        print('\n Test 56: Group commit of concurrent inserts')
+        print(results)
+
+        self.assertIsInstance(results[None], IntegrityError)
+        self.assertEqual(len(set(ids)), 4)
+        self.assertEqual(sorted((row.id, row.name) for row in rows),
+                         sorted(zip(ids, names[:4])))
+        self.assertEqual(coalescer.batches, 1)
+        self.assertEqual(coalescer.writes, 5)
+        if engine.dialect.name == 'postgresql':
+            # committed together
+            self.assertEqual(len(set(row.updated_txid for row in rows)), 1)
+
+# Below test checks that the change feed migration numbers the existing
+# rows on SQLite after the changes already counted, so a full sync of the
+# feed returns them
+
+    def test_migration_change_feed_sqlite(self):
+
+        path = os.path.join(tempfile.mkdtemp(), 'migration.db')
+        engine = create_engine('sqlite:///' + path)
+        with engine.begin() as connection:
+            for statement in [
+                    'CREATE TABLE actors (id INTEGER PRIMARY KEY, '
+                    'name VARCHAR, age INTEGER, gender VARCHAR)',
+                    'CREATE TABLE movies (id INTEGER PRIMARY KEY, '
+                    'title VARCHAR, release_date DATE)',
+                    'CREATE TABLE change_counter (id INTEGER PRIMARY KEY, '
+                    'value BIGINT NOT NULL)',
+                    "INSERT INTO actors VALUES (1, 'Ann', 30, 'female'), "
+                    "(2, 'Bob', 40, 'male'), (3, 'Cy', 50, 'male')",
+                    "INSERT INTO movies VALUES (1, 'Up', '2009-05-29'), "
+                    "(2, 'Cars', '2006-06-09')",
+                    'INSERT INTO change_counter VALUES (1, 10)']:
+                connection.execute(text(statement))
+        with engine.begin() as connection:
+            run_migration(connection, '3f9c2a7d1b04')
+        with engine.connect() as connection:
+            actors = [row[0] for row in connection.execute(text(
+                'SELECT updated_seq FROM actors ORDER BY id'))]
+            movies = [row[0] for row in connection.execute(text(
+                'SELECT updated_seq FROM movies ORDER BY id'))]
+            counter = connection.execute(text(
+                'SELECT value FROM change_counter')).scalar()
+        engine.dispose()
+        print('\n Test 57: Change feed migration numbers existing rows')
+        print(actors, movies, counter)
+
+        self.assertEqual(actors, [11, 12, 13])
+        self.assertEqual(movies, [14, 15])
+        self.assertEqual(counter, 15)
+
+# Runs migration 8b1e4c6d2a90 up and down on engine, on actors and movies
+# tables with NULLs in the columns it makes NOT NULL. Returns the indexes,
+# the nullable columns and the rows after the upgrade and the indexes and
+# nullable columns after the downgrade
+
+    def migrate_indexes_and_not_null(self, engine):
+
+        with engine.connect() as connection:
+            for statement in [
+                    'DROP TABLE IF EXISTS actors',
+                    'DROP TABLE IF EXISTS movies',
+                    'CREATE TABLE actors (id INTEGER PRIMARY KEY, '
+                    'name VARCHAR, age INTEGER, gender VARCHAR, '
+                    'updated_seq BIGINT)',
+                    'CREATE TABLE movies (id INTEGER PRIMARY KEY, '
+                    'title VARCHAR, release_date DATE, updated_seq BIGINT)',
+                    "INSERT INTO actors VALUES (1, 'Ann', 30, 'female', 1), "
+                    "(2, NULL, 40, NULL, 2)",
+                    "INSERT INTO movies VALUES (1, NULL, '2009-05-29', 3)"]:
+                connection.execute(text(statement))
+            if engine.dialect.name == 'postgresql':
+                connection.execute(text(
+                    'CREATE SEQUENCE IF NOT EXISTS catalog_change_seq'))
+
+        def schema():
+            inspector = sqlalchemy_inspect(engine)
+            indexes = sorted(index['name'] for table in ('actors', 'movies')
+                             for index in inspector.get_indexes(table))
+            nullable = sorted('%s.%s' % (table, column['name'])
+                              for table in ('actors', 'movies')
+                              for column in inspector.get_columns(table)
+                              if column['nullable'])
+            return indexes, nullable
+
+        with engine.connect() as connection:
+            run_migration(connection, '8b1e4c6d2a90')
+        upgraded = schema()
+        with engine.connect() as connection:
+            rows = connection.execute(text(
+                'SELECT name, gender FROM actors ORDER BY id')).fetchall() + \
+                connection.execute(text('SELECT title FROM movies')).fetchall()
+            run_migration(connection, '8b1e4c6d2a90', 'downgrade')
+        downgraded = schema()
+        return upgraded, [tuple(row) for row in rows], downgraded
+
+    def check_indexes_and_not_null(self, engine):
+
+        upgraded, rows, downgraded = self.migrate_indexes_and_not_null(engine)
+        print(upgraded, rows, downgraded)
+
+        self.assertEqual(upgraded[0], [
+            'ix_actors_name', 'ix_movies_release_date', 'ix_movies_title'])
+        self.assertEqual(upgraded[1], ['actors.age', 'actors.updated_seq',
+                                       'movies.release_date',
+                                       'movies.updated_seq'])
+        self.assertEqual(rows, [('Ann', 'female'), ('', 'unknown'), ('',)])
+        self.assertEqual(downgraded[0], [])
+        self.assertEqual(downgraded[1], [
+            'actors.age', 'actors.gender', 'actors.name', 'actors.updated_seq',
+            'movies.release_date', 'movies.title', 'movies.updated_seq'])
+
+# Below test checks migration 8b1e4c6d2a90 on SQLite: the indexes and NOT
+# NULL columns are added and removed again, NULLs are backfilled
+
+    def test_migration_indexes_and_not_null_sqlite(self):
+
+        engine = create_engine('sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'migration.db'))
+        print('\n Test 58: Online migration on SQLite')
+        self.check_indexes_and_not_null(engine)
+        engine.dispose()
+
+# Below test checks migration 8b1e4c6d2a90 on Postgres, with the indexes
+# built concurrently, the NOT NULL constraints validated and the NULLs
+# backfilled in batches. It needs an empty Postgres database in
+# TEST_MIGRATION_DATABASE_URL
+
+    @unittest.skipUnless(
+        os.environ.get('TEST_MIGRATION_DATABASE_URL'),
+        'TEST_MIGRATION_DATABASE_URL not set')
+    def test_migration_indexes_and_not_null_postgres(self):
+
+        engine = create_engine(os.environ['TEST_MIGRATION_DATABASE_URL'])
+        print('\n Test 59: Online migration on Postgres')
+        self.check_indexes_and_not_null(engine)
+        engine.dispose()
+
+# Below test checks movies partitioned by release date (Postgres only).
+# The test database is converted once; every run adds a partition older
+# than all others, writes a movie into it and detaches it again (the table
+# of a detached partition is kept)
+
+    def test_movies_partitioned(self):
+
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+        headers = {'Authorization': jwt_tokens['executive_producer']}
+
+        with engine.begin() as connection:
+            if not partitions.is_partitioned(connection):
+                partitions.convert(connection, 'decade', 1)
+            interval = partitions.current_interval(connection)
+            years = partitions.INTERVALS[interval]
+            # before every movie and every partition, also the detached
+            # ones of earlier runs
+            tables = connection.execute(text(
+                "SELECT relname FROM pg_class WHERE relkind IN ('r', 'p')"))
+            starts = [int(partitions.PARTITION_NAME.match(table).group(2))
+                      for (table,) in tables
+                      if partitions.PARTITION_NAME.match(table)]
+            oldest = connection.execute(text(
+                'SELECT MIN(release_date) FROM movies')).scalar()
+            starts.append(partitions.partition_start(oldest.year, interval))
+            start = min(starts) - years
+            name = partitions.add_partition(connection, start, interval)
+
+        res = self.client().post('/movies', json={
+            "title": "Partitioned", "release_date": "%d-06-01" % start},
+            headers=headers)
+        movie_id = json.loads(res.data)['movie_added']['id']
+        patched = self.client().patch(
+            '/movies/%d' % movie_id, json={"title": "Repartitioned"},
+            headers=headers)
+        window = self.client().get(
+            '/movies?release_date_from=%d-01-01&release_date_to=%d-12-31'
+            % (start, start + years - 1), headers=headers)
+        with engine.connect() as connection:
+            plan = '\n'.join(row[0] for row in connection.execute(text(
+                'EXPLAIN SELECT * FROM movies WHERE release_date >= :low '
+                'AND release_date <= :high'),
+                low=date(start, 1, 1), high=date(start + years - 1, 12, 31)))
+        before = json.loads(self.client().get('/stats', headers=headers).data)
+        token = json.loads(self.client().get(
+            '/movies/changes', headers=headers).data)['next_token']
+
+        with engine.begin() as connection:
+            detached = partitions.detach(connection, start + years)
+        after = json.loads(self.client().get('/stats', headers=headers).data)
+        feed = json.loads(self.client().get(
+            '/movies/changes?since=%s' % token, headers=headers).data)
+        lookup = json.loads(self.client().get(
+            '/movies?ids=%d' % movie_id, headers=headers).data)
+        print('\n Test 60: Movies partitioned by release date')
+        print(name, detached, plan)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(patched.status_code, 200)
+        self.assertEqual(
+            [movie['title'] for movie in json.loads(window.data)['movies']],
+            ['Repartitioned'])
+        # only the partition of the window is scanned
+        self.assertNotIn('movies_default', plan)
+        self.assertEqual(set(re.findall(r'\bmovies_[yd]\d{4}\b', plan)),
+                         {name})
+        self.assertEqual(detached, [name])
+        self.assertEqual(after['movies']['total'],
+                         before['movies']['total'] - 1)
+        self.assertEqual(feed['changes'], [{'op': 'delete', 'id': movie_id}])
+        self.assertEqual(lookup['missing'], [movie_id])
+
 # From app directory, run 'python test_app.py' to start tests
 
 if __name__ == "__main__":
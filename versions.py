@@ -0,0 +1,43 @@
+from flask import request, abort
+
+'''
+Optimistic concurrency for PATCH and DELETE
+
+Actors and movies have a version column (version_id_col of the
+mappers), so every UPDATE and DELETE of the ORM runs as
+    ... WHERE id = :id AND version = :version_loaded
+and increments the version; a row that changed since it was loaded
+raises StaleDataError instead of being overwritten. No row lock is held
+between reading the row and writing it.
+
+The version is sent as the ETag of the record. A client that sends it
+back in If-Match gets 412 Precondition Failed when the record changed
+in the meantime, and writes without If-Match that lose the race get
+409 Conflict.
+'''
+
+
+def with_etag(response, record):
+    response.set_etag(str(record.version))
+    return response
+
+
+def check_if_match(record):
+    """Aborts with 412 when the request has an If-Match header without
+    the current version of record
+    """
+    if request.if_match and \
+            not request.if_match.contains(str(record.version)):
+        abort(412, {
+            'message': 'The record was changed, current version is %s' %
+                       record.version})
+
+
+def stale_write():
+    """Response for a write that found the row changed by another
+    request
+    """
+    if request.if_match:
+        abort(412, {'message': 'The record was changed by another request'})
+    abort(409, {
+        'message': 'The record was changed by another request, please retry'})
@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import time
+from datetime import date
+from sqlalchemy import orm
+
+import auth
+import events
+import stats
+from changes import change_feed
+from models import db, Actors, Movies, CatalogStats
+from prefork import engines
+from queries import (get_by_id, list_by_ids, compile_list_by_id,
+                     list_movies_released)
+
+'''
+Warm-up of a worker before it takes traffic
+
+The first requests of a fresh worker used to pay for everything that is
+built lazily: the mapper configuration, compiling the queries, the
+database connections and the download of the Auth0 signing keys. Every
+gunicorn worker now runs warm_up_worker() before it accepts a request
+(post_worker_init in gunicorn.conf.py):
+    - the signing keys are downloaded, unless the worker already has
+      them from the master (preload_app)
+    - every query of the hot endpoints runs once
+    - the LISTEN thread of events.py is started when the read model
+      needs it
+    - WARM_UP_CONNECTIONS connections to each database are opened and
+      left in the pool
+With preload_app the master runs prime() before forking as well, so
+the work is shared by the workers (see prefork.py).
+
+The warm-up runs once, in a thread of its own; post_worker_init waits
+for its first attempt, at most WARM_UP_TIMEOUT seconds (below gunicorn's
+timeout, the arbiter kills a worker that doesn't start). A failed attempt (database or Auth0 not
+reachable) is retried every WARM_UP_RETRY seconds in that thread.
+GET /readyz only reports the state: 200 once the warm-up succeeded, 503
+before. GET /healthz only tells that the worker is alive.
+'''
+
+WARM_UP_CONNECTIONS = int(os.environ.get('WARM_UP_CONNECTIONS', '2'))
+WARM_UP_RETRY = float(os.environ.get('WARM_UP_RETRY', '5'))
+WARM_UP_TIMEOUT = float(os.environ.get('WARM_UP_TIMEOUT', '10'))
+
+
+def prime(app):
+    """Runs the queries of the hot endpoints once, which compiles them
+    (and loads the read model, if enabled). Every query is bounded: the
+    full list of GET /actors and /movies would read whole tables, its
+    statement is compiled but only one row is read
+    """
+    orm.configure_mappers()
+    with app.app_context():
+        for model, key in ((Actors, 'actor'), (Movies, 'movie')):
+            # id 0 doesn't exist
+            get_by_id(model, 0)
+            list_by_ids(model, [0])
+            compile_list_by_id(model)
+            change_feed(model, key, (0, 0), limit=1)
+        list_movies_released(date.today(), date.today())
+        stats.read(db.session, CatalogStats.__table__)
+        db.session.remove()
+        read_model = app.extensions.get('read_model')
+        if read_model is not None:
+            read_model.reload(db.get_engine(app))
+
+
+def prefetch_keys():
+    if auth.jwks_cache.keys is None:
+        auth.jwks_cache.fetch()
+
+
+def start_listener(app):
+    """Starts the LISTEN thread the read model needs to see the writes
+    of the other workers (EVENTS_PG_NOTIFY=true). Runs in the worker,
+    a thread started in the master would not survive the fork
+    """
+    if app.extensions.get('read_model') is not None:
+        with app.app_context():
+            events.broker.ensure_listener(db.get_engine(app))
+
+
+def open_connections(app, count=WARM_UP_CONNECTIONS):
+    """Opens count connections to the primary and to every replica and
+    returns them to the pool, where they stay open
+    """
+    with app.app_context():
+        for engine in engines(app):
+            connections = [engine.connect() for number in range(count)]
+            for connection in connections:
+                connection.close()
+
+
+class WarmUp:
+    def __init__(self, retry_after=WARM_UP_RETRY):
+        self.retry_after = retry_after
+        self.ready = False
+        # seconds the warm-up took, error of the last failed attempt
+        self.seconds = None
+        self.error = None
+        self.attempts = 0
+        # set once the first attempt is over
+        self.attempted = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _attempt(self, app):
+        start = time.monotonic()
+        try:
+            prime(app)
+            start_listener(app)
+            open_connections(app)
+            prefetch_keys()
+        except Exception as error:
+            print(sys.exc_info())
+            self.error = repr(error)
+            return False
+        self.seconds = time.monotonic() - start
+        self.error = None
+        self.ready = True
+        return True
+
+    def _run(self, app):
+        while True:
+            self.attempts += 1
+            ready = self._attempt(app)
+            self.attempted.set()
+            if ready:
+                return
+            time.sleep(self.retry_after)
+
+    def start(self, app):
+        """Starts the warm-up thread unless it was started already"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, args=(app,), daemon=True)
+                self.thread.start()
+
+
+def init_warm_up(app):
+    app.extensions['warm_up'] = WarmUp()
+    return app.extensions['warm_up']
+
+
+def warm_up_worker(app, timeout=WARM_UP_TIMEOUT):
+    """Starts the warm-up and waits up to timeout seconds for its first
+    attempt. Returns whether the worker is ready, a worker that isn't
+    keeps warming up in the background (see /readyz)
+    """
+    warm_up = app.extensions['warm_up']
+    warm_up.start(app)
+    warm_up.attempted.wait(timeout)
+    return warm_up.ready